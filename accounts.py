@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import sqlite3
+
+from archive import archive_paths
+from cache import MISSING, LRUCache
+from migrate import _next_provisional_id
+from reconcile import _merge_checkpoints
+
+logger = logging.getLogger(__name__)
+
+
+def _find_user_id(conn, username):
+    result = conn.execute('SELECT user_id FROM accounts WHERE username = ?', (username,)).fetchone()
+    return result[0] if result else None
+
+def _get_user_ids(conn, usernames):
+    found = {}
+    for i in range(0, len(usernames), 500):
+        chunk = usernames[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        found.update(conn.execute(f'SELECT username, user_id FROM accounts WHERE username IN ({placeholders})', chunk))
+    return found
+
+def _provisional_accounts(conn, usernames):
+    # username -> user id, creating provisional (negative id) accounts for
+    # names that no account has yet
+    found = _get_user_ids(conn, usernames)
+    missing = [username for username in dict.fromkeys(usernames) if username not in found]
+    if missing:
+        first = _next_provisional_id(conn)
+        rows = [(first - i, username) for i, username in enumerate(missing)]
+        conn.executemany('INSERT INTO accounts (user_id, username) VALUES (?, ?)', rows)
+        found.update((username, user_id) for user_id, username in rows)
+    return found
+
+def _get_accounts(conn, user_ids):
+    # user id -> (username, chat_id)
+    found = {}
+    for i in range(0, len(user_ids), 500):
+        chunk = user_ids[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        for user_id, username, chat_id in conn.execute(
+                f'SELECT user_id, username, chat_id FROM accounts WHERE user_id IN ({placeholders})', chunk):
+            found[user_id] = (username, chat_id)
+    return found
+
+def _rekey_archives(archive_dir, old_id, new_id):
+    for path in archive_paths(archive_dir):
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute('UPDATE transactions SET sender_id = ? WHERE sender_id = ?', (new_id, old_id))
+            conn.execute('UPDATE transactions SET receiver_id = ? WHERE receiver_id = ?', (new_id, old_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+def _merge_account(conn, old_id, new_id, archive_dir):
+    # Hands a provisional account's balance and history to its real owner
+    # and returns the owner's new balance. merged_accounts redirects credits
+    # still on their way to the old id.
+    balance = conn.execute('DELETE FROM accounts WHERE user_id = ? RETURNING balance', (old_id,)).fetchone()[0]
+    conn.execute('INSERT OR REPLACE INTO merged_accounts (old_id, new_id) VALUES (?, ?)', (old_id, new_id))
+    conn.execute('UPDATE transactions SET sender_id = ? WHERE sender_id = ?', (new_id, old_id))
+    conn.execute('UPDATE transactions SET receiver_id = ? WHERE receiver_id = ?', (new_id, old_id))
+    _merge_checkpoints(conn, old_id, new_id)
+    if archive_dir is not None:
+        # Not atomic with the commit above, but idempotent: a failed batch
+        # is retried on the next flush and a crash on the user's next update
+        _rekey_archives(archive_dir, old_id, new_id)
+    return conn.execute('''
+        INSERT INTO accounts (user_id, balance) VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance
+        RETURNING balance
+    ''', (new_id, balance)).fetchone()[0]
+
+def _register_accounts(conn, entries, archive_dir):
+    # entries are (user_id, username, chat_id) as last seen. Returns the
+    # balances that changed through merges, None for accounts merged away,
+    # and whether an existing account's name changed.
+    changed = {}
+    renamed = False
+    for user_id, username, chat_id in entries:
+        if username is not None:
+            holder = _find_user_id(conn, username)
+            if holder is not None and holder != user_id:
+                if holder < 0:
+                    changed[holder] = None
+                    changed[user_id] = _merge_account(conn, holder, user_id, archive_dir)
+                else:
+                    # The name belonged to someone who has since renamed
+                    conn.execute('UPDATE accounts SET username = NULL WHERE user_id = ?', (holder,))
+                    renamed = True
+        previous = conn.execute('SELECT username FROM accounts WHERE user_id = ?', (user_id,)).fetchone()
+        if previous is not None and previous[0] != username:
+            renamed = True
+        conn.execute('''
+            INSERT INTO accounts (user_id, username, chat_id) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, chat_id = excluded.chat_id
+        ''', (user_id, username, chat_id))
+    return changed, renamed
+
+
+class AccountRegistry:
+    # Who is who. Keeps user id -> (username, chat id) for everyone seen
+    # since startup and an LRU of username -> user id for resolving the
+    # names typed into /pay, /lookup and friends.
+    #
+    # Seeing a user again unchanged is free; new chats are written together
+    # every `interval` seconds. Writing a username that a provisional
+    # account holds merges that account into the user's own, so money sent
+    # to a name before its owner ever used the bot (or before a rename) ends
+    # up with them. New users and renames are therefore written before
+    # remember() returns, so the handler already sees the merged balance.
+
+    def __init__(self, ledger, interval=5.0, cache_size=10000):
+        self.ledger = ledger
+        self.interval = interval
+        self.user_ids = LRUCache(cache_size)
+        self._known = {}
+        self._dirty = {}
+        self._registering = {}  # user id -> write of a new user or name in progress
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._task = None
+
+    async def remember(self, user_id, username, chat_id):
+        registering = self._registering.get(user_id)
+        if registering is not None:
+            # Another update of the same user got here first
+            await asyncio.shield(registering)
+        known = self._known.get(user_id)
+        if known == (username, chat_id):
+            return
+        if known is not None and known[0] is not None and known[0] != username:
+            self.user_ids.invalidate(known[0])
+        if username is not None:
+            self.user_ids.put(username, user_id)
+        self._known[user_id] = (username, chat_id)
+        if known is not None and known[0] == username:
+            self._dirty[user_id] = (username, chat_id)
+            self._wakeup.set()
+            return
+        self._dirty.pop(user_id, None)
+        registering = self._registering[user_id] = asyncio.ensure_future(self._store({user_id: (username, chat_id)}))
+        try:
+            await asyncio.shield(registering)
+        except Exception:
+            # The next flush tries again
+            self._dirty.setdefault(user_id, (username, chat_id))
+            self._wakeup.set()
+            raise
+        finally:
+            if self._registering.get(user_id) is registering:
+                del self._registering[user_id]
+
+    async def resolve(self, username, create=False):
+        # The user id for a username, None if nobody has it. With `create`,
+        # an unknown name gets a provisional account so it can be paid.
+        user_id = self.user_ids.get(username)
+        if user_id is not MISSING:
+            return user_id
+        if create:
+            return (await self.resolve_many([username], create=True))[username]
+        generation = self.user_ids.generation
+        user_id = await self.ledger.read(_find_user_id, username)
+        if user_id is not None:
+            self.user_ids.fill(username, user_id, generation)
+        return user_id
+
+    async def resolve_many(self, usernames, create=False):
+        # username -> user id for every name that has (or, with `create`, now has) an account
+        found = {}
+        missing = []
+        for username in usernames:
+            user_id = self.user_ids.get(username)
+            if user_id is MISSING:
+                missing.append(username)
+            else:
+                found[username] = user_id
+        if missing:
+            generation = self.user_ids.generation
+            if create:
+                resolved = await self.ledger.write(_provisional_accounts, missing)
+            else:
+                resolved = await self.ledger.read(_get_user_ids, missing)
+            for username, user_id in resolved.items():
+                if create:
+                    self.user_ids.put(username, user_id)
+                else:
+                    self.user_ids.fill(username, user_id, generation)
+            found.update(resolved)
+        return found
+
+    async def _lookup(self, user_ids):
+        missing = [user_id for user_id in user_ids if user_id not in self._known]
+        found = await self.ledger.read(_get_accounts, missing) if missing else {}
+        return {user_id: self._known.get(user_id) or found.get(user_id) for user_id in user_ids}
+
+    async def get_chat_id(self, user_id):
+        return (await self.get_chat_ids([user_id])).get(user_id)
+
+    async def get_chat_ids(self, user_ids):
+        # user id -> chat id for every user we can reach
+        return {user_id: account[1] for user_id, account in (await self._lookup(user_ids)).items()
+                if account is not None and account[1] is not None}
+
+    async def names(self, user_ids):
+        # user id -> username, or the id itself for users without one
+        return {user_id: account[0] if account is not None and account[0] is not None else user_id
+                for user_id, account in (await self._lookup(user_ids)).items()}
+
+    async def _store(self, entries):
+        changed, renamed = await self.ledger.write(_register_accounts, [(user_id, *entry) for user_id, entry in entries.items()],
+                                                   self.ledger.archive_dir)
+        if changed:
+            logger.info('Merged %d provisional accounts', sum(balance is None for balance in changed.values()))
+            self.ledger.changed({'accounts', 'transactions'}, changed)
+        elif renamed:
+            # No balance moved, but every listing showing the old name is stale
+            self.ledger.changed({'accounts'})
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        entries, self._dirty = self._dirty, {}
+        try:
+            await self._store(entries)
+        except Exception:
+            # Keep the ones that have not changed again meanwhile for the next round
+            for user_id, entry in entries.items():
+                if self._known.get(user_id) == entry:
+                    self._dirty.setdefault(user_id, entry)
+            raise
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            await self._wakeup.wait()
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Failed to store accounts, retrying on the next change')
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._task:
+            await self._task
+            self._task = None
@@ -0,0 +1,122 @@
+import functools
+import time
+
+from ratelimit import TokenBucket
+
+# Built-in limits per handler (the names handlers are registered under in
+# main.py). RATE_LIMITS in config.json is merged over these one handler at a
+# time; a handler set to null there is not limited at all. Each entry takes
+# `user_rate`/`user_burst` (per user) and `global_rate`/`global_burst`
+# (across everyone), in requests per second.
+DEFAULT_LIMITS = {
+    'claim': {'user_rate': 0.1, 'user_burst': 2},
+    'pay': {'user_rate': 0.5, 'user_burst': 5},
+    'payment_callback': {'user_rate': 1, 'user_burst': 5},
+    'explorer': {'user_rate': 0.5, 'user_burst': 5},
+    'explorer_callback': {'user_rate': 1, 'user_burst': 5},
+    'history': {'user_rate': 0.5, 'user_burst': 5},
+    'history_callback': {'user_rate': 1, 'user_burst': 5},
+}
+
+
+def load_limits(overrides=None):
+    limits = dict(DEFAULT_LIMITS)
+    for name, limit in (overrides or {}).items():
+        if limit is None:
+            limits.pop(name, None)
+        else:
+            limits[name] = dict(limits.get(name, {}), **limit)
+    return limits
+
+def _payload(update):
+    # What makes two updates the same request: the button or the command
+    # line. Anything else, like an uploaded file, is a request of its own.
+    if update.callback_query is not None:
+        return update.callback_query.data
+    if update.message is not None and update.message.text is not None:
+        return update.message.text
+    return update.update_id
+
+
+class Admission:
+    # Decides, in memory and before a handler runs, whether an update gets
+    # to run at all. An update is shed when its user's bucket for that
+    # handler is empty, when the handler's global bucket is empty, or when
+    # the same user already has the identical request (same command line or
+    # button) in flight, which coalesces double taps and "Load more" mashing
+    # into one run. That last check applies to every handler, limited or
+    # not. Shed updates are dropped without a reply, so they cost neither a
+    # query nor a Telegram call.
+    #
+    # Per-user buckets are created on first use. A bucket that has refilled
+    # completely is the same as a new one, so those are swept out once the
+    # table has doubled since the last sweep.
+
+    def __init__(self, limits=None, clock=time.monotonic):
+        self.limits = load_limits() if limits is None else limits
+        self.clock = clock
+        self.observe_shed = None  # fn(handler, reason)
+        self._global = {name: TokenBucket(limit['global_rate'], limit.get('global_burst'), clock)
+                        for name, limit in self.limits.items() if limit.get('global_rate')}
+        self._users = {}
+        self._sweep_at = 1024
+        self._inflight = set()
+
+    def _user_bucket(self, name, user_id):
+        key = (name, user_id)
+        bucket = self._users.get(key)
+        if bucket is None:
+            if len(self._users) >= self._sweep_at:
+                self._sweep()
+            limit = self.limits[name]
+            bucket = self._users[key] = TokenBucket(limit['user_rate'], limit.get('user_burst'), self.clock)
+        return bucket
+
+    def _sweep(self):
+        for key, bucket in list(self._users.items()):
+            if bucket.delay(bucket.burst) == 0:
+                del self._users[key]
+        self._sweep_at = max(1024, 2 * len(self._users))
+
+    def _shed(self, name, reason):
+        if self.observe_shed is not None:
+            self.observe_shed(name, reason)
+
+    def admit(self, name, user_id):
+        # Takes a token from the user's and the global bucket of `name`;
+        # False (and nothing taken) if either is empty
+        limit = self.limits.get(name)
+        if limit is None:
+            return True
+        user = self._user_bucket(name, user_id) if limit.get('user_rate') and user_id is not None else None
+        if user is not None and not user.try_take():
+            self._shed(name, 'user')
+            return False
+        shared = self._global.get(name)
+        if shared is not None and not shared.try_take():
+            if user is not None:
+                user.tokens += 1
+            self._shed(name, 'global')
+            return False
+        return True
+
+    def guard(self, name, callback):
+        # Wraps a handler callback with admission control
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            user = update.effective_user
+            key = (name, user.id if user else None, _payload(update))
+            if key in self._inflight:
+                self._shed(name, 'duplicate')
+                return
+            if not self.admit(name, key[1]):
+                return
+            self._inflight.add(key)
+            try:
+                return await callback(update, context)
+            finally:
+                self._inflight.discard(key)
+        return wrapper
+
+    def stats(self):
+        return {'buckets': len(self._users), 'inflight': len(self._inflight)}
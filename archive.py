@@ -0,0 +1,232 @@
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+# Old transactions live in one SQLite file per month under the archive
+# directory (transactions-YYYY-MM.db), keeping the hot table small. Rows
+# are copied to their archive before they are deleted from the hot table,
+# so every id below the oldest hot row is always in an archive. Readers
+# that run off the end of the hot table carry on in the archives, newest
+# month first, and skip anything the hot table already returned.
+
+ARCHIVE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY,
+        sender_id INTEGER,
+        receiver_id INTEGER,
+        amount INTEGER,
+        timestamp DATETIME
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_transactions_sender_id ON transactions (sender_id, id)',
+    'CREATE INDEX IF NOT EXISTS idx_transactions_receiver_id ON transactions (receiver_id, id)',
+]
+
+PREFIX = 'transactions-'
+
+
+def archive_paths(directory):
+    # Oldest month first
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, name) for name in sorted(names) if name.startswith(PREFIX) and name.endswith('.db')]
+
+def archive_path(directory, month):
+    return os.path.join(directory, f'{PREFIX}{month}.db')
+
+@contextmanager
+def attached(conn, path, name='archive'):
+    # ATTACH is not allowed inside a transaction, so only use this on an
+    # autocommit connection between statements
+    conn.execute(f'ATTACH DATABASE ? AS {name}', (path,))
+    try:
+        yield name
+    finally:
+        conn.execute(f'DETACH DATABASE {name}')
+
+
+# Queries against the hot database
+def _archive_bound(conn, cutoff, limit_id):
+    # Rows below the returned id are old enough to archive. The first recent
+    # row ends the range, so a late timestamp never leaves a gap behind it.
+    row = conn.execute('SELECT id FROM transactions WHERE timestamp >= ? ORDER BY id LIMIT 1', (cutoff,)).fetchone()
+    bound = row[0] if row else conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM transactions').fetchone()[0]
+    return bound if limit_id is None else min(bound, limit_id + 1)
+
+# The operations below run on the writer thread, like account merges that
+# rewrite ids inside the archives, so the two never interleave.
+def _archive_batch(conn, directory, bound, limit):
+    # Copy first, delete second: a crash in between leaves the rows in both
+    # places, which readers already tolerate. Returns the number moved.
+    rows = conn.execute('SELECT id, sender_id, receiver_id, amount, timestamp FROM transactions WHERE id < ? ORDER BY id LIMIT ?',
+                        (bound, limit)).fetchall()
+    if rows:
+        _store_archived(directory, rows)
+        conn.execute('DELETE FROM transactions WHERE id <= ?', (rows[-1][0],))
+    return len(rows)
+
+def _restore_batch(conn, path, before_id, limit):
+    # Copies the newest archived rows below `before_id` back into the hot
+    # table; returns the lowest id copied, None once the file is done
+    rows = _read_archived(path, before_id, limit)
+    conn.executemany('INSERT OR IGNORE INTO transactions (id, sender_id, receiver_id, amount, timestamp) VALUES (?, ?, ?, ?, ?)',
+                     rows)
+    return rows[-1][0] if rows else None
+
+def _remove_archive(conn, path):
+    os.remove(path)
+
+
+# Archive files
+def _store_archived(directory, rows):
+    os.makedirs(directory, exist_ok=True)
+    months = {}
+    for row in rows:
+        months.setdefault((row[4] or '0000-00')[:7], []).append(row)
+    for month, month_rows in months.items():
+        conn = sqlite3.connect(archive_path(directory, month))
+        try:
+            conn.execute('PRAGMA synchronous=FULL')
+            for statement in ARCHIVE_SCHEMA:
+                conn.execute(statement)
+            conn.executemany('INSERT OR IGNORE INTO transactions (id, sender_id, receiver_id, amount, timestamp) VALUES (?, ?, ?, ?, ?)',
+                             month_rows)
+            conn.commit()
+        finally:
+            conn.close()
+
+def _read_archived(path, before_id, limit):
+    # Newest first, below `before_id`
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT id, sender_id, receiver_id, amount, timestamp FROM transactions WHERE id < ? ORDER BY id DESC LIMIT ?',
+                            (before_id, limit)).fetchall()
+    finally:
+        conn.close()
+
+
+class Archiver:
+    # Moves transactions older than `max_age_days` out of the hot table in
+    # batches, every `interval` seconds while the bot runs. `limit_id`, if
+    # set, returns the highest id that may leave the hot table yet (e.g. the
+    # last one the exporter has written out).
+
+    def __init__(self, ledger, directory='archive', max_age_days=90, interval=3600, batch_size=1000):
+        self.ledger = ledger
+        self.directory = directory
+        self.max_age_days = max_age_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.limit_id = None
+        self.archived = 0
+        self._stopping = asyncio.Event()
+        self._task = None
+
+    async def archive(self):
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=self.max_age_days)).strftime('%Y-%m-%d %H:%M:%S')
+        limit_id = self.limit_id() if self.limit_id is not None else None
+        bound = await self.ledger.read(_archive_bound, cutoff, limit_id)
+        moved = 0
+        while not self._stopping.is_set():
+            count = await self.ledger.write(_archive_batch, self.directory, bound, self.batch_size)
+            if not count:
+                break
+            moved += count
+        if moved:
+            self.archived += moved
+            logger.info('Archived %d transactions older than %s', moved, cutoff)
+        return moved
+
+    async def restore(self, month):
+        # Moves every archived month from `month` on back into the hot table.
+        # Newest rows go first, so the hot table never has a hole in it.
+        # Raise ARCHIVE_AFTER_DAYS first or the archiver will move them out again.
+        restored = 0
+        for path in reversed(archive_paths(self.directory)):
+            if os.path.basename(path) < os.path.basename(archive_path(self.directory, month)):
+                break
+            before_id = 2 ** 63 - 1
+            while before_id is not None:
+                before_id = await self.ledger.write(_restore_batch, path, before_id, self.batch_size)
+            restored += 1
+            await self.ledger.write(_remove_archive, path)
+        if restored:
+            logger.info('Restored %d archived months from %s on', restored, month)
+        return restored
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await self.archive()
+            except Exception:
+                logger.exception('Archiving failed, retrying in %ss', self.interval)
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        # Lets the batch in progress finish
+        self._stopping.set()
+        if self._task:
+            await self._task
+            self._task = None
+
+
+async def _main(args):
+    from exporter import Exporter
+    from ledger import Ledger
+    from reconcile import _latest_checkpoint
+
+    ledger = Ledger(args.db, archive_dir=args.dir)
+    archiver = Archiver(ledger, args.dir, max_age_days=args.days or 0)
+    try:
+        if args.command == 'archive':
+            # Leave rows transactions.txt or the reconciler have not caught
+            # up with to the bot
+            checkpoint = await ledger.read(_latest_checkpoint)
+            verified_id = checkpoint[1] if checkpoint else 0
+            exported_id = Exporter(ledger).exported_id
+            archiver.limit_id = lambda: min(exported_id(), verified_id)
+            print(f'Archived {await archiver.archive()} transactions')
+        elif args.command == 'restore':
+            print(f'Restored {await archiver.restore(args.month)} archived months')
+        else:
+            for path in archive_paths(args.dir):
+                conn = sqlite3.connect(path)
+                count, first, last = conn.execute('SELECT COUNT(*), MIN(id), MAX(id) FROM transactions').fetchone()
+                conn.close()
+                print(f'{path}: {count} transactions, ids {first}-{last}')
+    finally:
+        ledger.close()
+
+def main():
+    # Safe to run while the bot is up: both sides go through SQLite locking
+    parser = argparse.ArgumentParser(description='Move old SevenX transactions to monthly archives and back')
+    parser.add_argument('--db', default='7x_currency.db')
+    parser.add_argument('--dir', default='archive', help='archive directory')
+    commands = parser.add_subparsers(dest='command', required=True)
+    archive_parser = commands.add_parser('archive', help='archive transactions older than --days')
+    archive_parser.add_argument('--days', type=int, required=True)
+    restore_parser = commands.add_parser('restore', help='move archives from a month (YYYY-MM) on back to the live table')
+    restore_parser.add_argument('month')
+    commands.add_parser('list', help='show the archive files')
+    args = parser.parse_args()
+    if args.command != 'archive':
+        args.days = None
+    asyncio.run(_main(args))
+
+if __name__ == '__main__':
+    main()
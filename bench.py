@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from telegram import CallbackQuery, Chat, Message, Update, User
+
+from fakebot import FakeBot
+from ledger import _create_schema
+
+# Offline load test for the command handlers in main.py. It seeds a
+# throwaway database, builds synthetic Updates bound to a FakeBot, drives
+# the real handlers concurrently and prints throughput and latency
+# percentiles per command.
+#
+#   python bench.py --users 10000 --transactions 100000 --requests 2000
+
+COMMANDS = ['balance', 'claim', 'pay', 'explorer', 'explorer_deep', 'history', 'top', 'supply']
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def seed(path, users, transactions):
+    conn = sqlite3.connect(path)
+    _create_schema(conn)
+    # user{i} has user id i + 1, see Harness.user
+    conn.executemany('INSERT INTO accounts (user_id, username, chat_id, balance) VALUES (?, ?, ?, ?)',
+                     ((i + 1, f'user{i}', i + 1, random.randint(100, 100000)) for i in range(users)))
+    conn.executemany('INSERT INTO transactions (sender_id, receiver_id, amount) VALUES (?, ?, ?)',
+                     ((random.randint(1, users), random.randint(1, users), random.randint(1, 100))
+                      for _ in range(transactions)))
+    conn.execute('UPDATE supply SET total = (SELECT COALESCE(SUM(balance), 0) FROM accounts) WHERE id = 0')
+    conn.commit()
+    conn.close()
+
+
+class Harness:
+    def __init__(self, main, bot, users):
+        self.main = main
+        self.bot = bot
+        self.users = users
+        self._claimers = itertools.count()
+        self._user_ids = {}
+
+    def user(self, username):
+        # Seeded users keep their ids; everyone else gets one above them
+        if username.startswith('user'):
+            user_id = int(username[4:]) + 1
+        else:
+            user_id = self._user_ids.setdefault(username, self.users + len(self._user_ids) + 1)
+        return User(id=user_id, first_name=username, is_bot=False, username=username)
+
+    def message(self, username, text):
+        user = self.user(username)
+        message = Message(message_id=next(_message_ids), date=datetime.now(timezone.utc),
+                          chat=Chat(id=user.id, type=Chat.PRIVATE), from_user=user, text=text)
+        message.set_bot(self.bot)
+        return message
+
+    def command(self, username, text):
+        update = Update(update_id=next(_update_ids), message=self.message(username, text))
+        update.set_bot(self.bot)
+        context = SimpleNamespace(args=text.split()[1:], bot=self.bot)
+        return update, context
+
+    def callback(self, username, data):
+        query = CallbackQuery(id=str(next(_update_ids)), from_user=self.user(username), chat_instance='bench',
+                              data=data, message=self.message(username, 'prompt'))
+        query.set_bot(self.bot)
+        update = Update(update_id=next(_update_ids), callback_query=query)
+        update.set_bot(self.bot)
+        return update, SimpleNamespace(args=None, bot=self.bot)
+
+    def random_user(self):
+        return f'user{random.randrange(self.users)}'
+
+    # One scenario per command; each run is timed as a whole
+    async def balance(self):
+        await self.main.balance(*self.command(self.random_user(), '/balance'))
+
+    async def claim(self):
+        await self.main.claim(*self.command(f'claimer{next(self._claimers)}', '/claim'))
+
+    async def pay(self):
+        sender, receiver = self.random_user(), self.random_user()
+        await self.main.pay(*self.command(sender, f'/pay {receiver} 1'))
+        # Press the Confirm button of the prompt we were just sent
+        prompt = self.bot.last_message[self.user(sender).id]
+        confirm = prompt['reply_markup'].inline_keyboard[0][0].callback_data
+        await self.main.handle_callback(*self.callback(sender, confirm))
+
+    async def explorer(self):
+        await self.main.explorer(*self.command(self.random_user(), '/explorer'))
+
+    async def explorer_deep(self):
+        # A "Load more" press far down the feed
+        before_id = max(1, self.deepest_id // 10)
+        await self.main.handle_explorer_callback(*self.callback(self.random_user(), f'explorer_{before_id}'))
+
+    async def history(self):
+        await self.main.history(*self.command(self.random_user(), '/history'))
+
+    async def top(self):
+        await self.main.top(*self.command(self.random_user(), '/top'))
+
+    async def supply(self):
+        await self.main.supply(*self.command(self.random_user(), '/supply'))
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+async def run_command(scenario, requests, concurrency):
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            start = time.perf_counter()
+            await scenario()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'requests': requests,
+        'throughput': requests / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+async def run(args):
+    main = importlib.import_module('main')
+    bot = FakeBot(latency=args.bot_latency)
+    harness = Harness(main, bot, args.users)
+    harness.deepest_id = args.transactions
+
+    await main.on_startup(SimpleNamespace(bot=bot))
+    results = {}
+    try:
+        for name in args.commands:
+            results[name] = await run_command(getattr(harness, name), args.requests, args.concurrency)
+    finally:
+        await main.on_shutdown(SimpleNamespace(bot=bot))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test for the SevenX command handlers')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--transactions', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=1000, help='requests per command')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--bot-latency', type=float, default=0.0, help='simulated Telegram round trip in seconds')
+    parser.add_argument('--commands', type=lambda value: value.split(','), default=COMMANDS)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    unknown = set(args.commands) - set(COMMANDS)
+    if unknown:
+        parser.error(f'unknown commands: {", ".join(sorted(unknown))}')
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        with open('config.json', 'w') as f:
+            json.dump({
+                'TELEGRAM_BOT_TOKEN': 'bench',
+                'AUTHORIZED_USER': 'bench_admin',
+                'NOTIFY_GLOBAL_RATE': 100000,
+                'NOTIFY_CHAT_RATE': 100000,
+            }, f)
+        seed('7x_currency.db', args.users, args.transactions)
+        results = asyncio.run(run(args))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'{args.users} users, {args.transactions} transactions, '
+          f'{args.requests} requests per command, concurrency {args.concurrency}')
+    print(f'{"command":<15}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for name, result in results.items():
+        print(f'{name:<15}{result["throughput"]:>10.0f}{result["p50_ms"]:>10.2f}'
+              f'{result["p95_ms"]:>10.2f}{result["p99_ms"]:>10.2f}')
+
+if __name__ == '__main__':
+    main()
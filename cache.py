@@ -0,0 +1,70 @@
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache:
+    # Bounded LRU in front of SQLite: user id -> balance (None for unknown
+    # users) for the ledger, username -> user id for the account registry,
+    # cursor -> rendered page for /explorer.
+    # Only touched from the event loop, so it needs no locking.
+    #
+    # Writes go straight in with `put` once they are committed. Values read
+    # from SQLite go in with `fill`, which is skipped if any write landed
+    # while the read was in flight, so a slow read never overwrites a newer
+    # value.
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=MISSING):
+        value = self._entries.get(key, MISSING)
+        if value is MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.generation += 1
+        self._store(key, value)
+
+    def fill(self, key, value, generation):
+        if generation == self.generation:
+            self._store(key, value)
+
+    def invalidate(self, key=None):
+        self.generation += 1
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def _store(self, key, value):
+        if self.capacity <= 0:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,129 @@
+import argparse
+import csv
+import gzip
+import json
+import os
+import sqlite3
+from datetime import datetime
+from itertools import chain
+
+from archive import archive_paths
+
+# Full ledger dumps for audits: the transactions table (optionally a time
+# or id range of it) and a snapshot of every account, each written as a
+# gzip-compressed CSV or JSONL file. Rows are streamed from the database in
+# chunks straight into the compressor, so memory use does not depend on the
+# size of the ledger. Used by the /export command and from the shell:
+#
+#   python dump.py --format jsonl --since 2024-01-01 --out audit/
+
+FORMATS = ('csv', 'jsonl')
+CHUNK_SIZE = 1000
+
+TRANSACTION_COLUMNS = ('id', 'sender_id', 'receiver_id', 'amount', 'timestamp')
+ACCOUNT_COLUMNS = ('user_id', 'username', 'balance')
+
+
+def parse_time(value):
+    # Accepts a date or a date and time, returns it the way SQLite stores timestamps
+    for layout in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, layout).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            pass
+    raise ValueError(f'invalid date {value!r}, expected YYYY-MM-DD or YYYY-MM-DD HH:MM:SS')
+
+def _iter_rows(cursor, chunk_size=CHUNK_SIZE):
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield from rows
+
+def _iter_transactions(conn, since=None, until=None, from_id=None, to_id=None, below_id=None):
+    # since/until are inclusive/exclusive timestamps, from_id/to_id inclusive ids
+    conditions, params = [], []
+    for condition, value in (('timestamp >= ?', since), ('timestamp < ?', until),
+                             ('id >= ?', from_id), ('id <= ?', to_id), ('id < ?', below_id)):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+    return _iter_rows(conn.execute(f'SELECT {", ".join(TRANSACTION_COLUMNS)} FROM transactions{where} ORDER BY id', params))
+
+def _iter_archived(paths, below_id, *bounds):
+    # Archives have their own connections: ATTACH cannot happen inside the
+    # read transaction the hot rows come from
+    for path in paths:
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        try:
+            yield from _iter_transactions(conn, *bounds, below_id=below_id)
+        finally:
+            conn.close()
+
+def _iter_accounts(conn):
+    return _iter_rows(conn.execute(f'SELECT {", ".join(ACCOUNT_COLUMNS)} FROM accounts ORDER BY user_id'))
+
+def _write_rows(path, columns, rows, fmt):
+    count = 0
+    with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                f.write(json.dumps(dict(zip(columns, row))) + '\n')
+                count += 1
+    return count
+
+def write_dump(conn, directory, fmt='csv', since=None, until=None, from_id=None, to_id=None, archive_dir=None):
+    # Writes transactions.<fmt>.gz and accounts.<fmt>.gz into `directory` from
+    # one read transaction, so the balances match the transactions exactly.
+    # Archived transactions come first: everything below the oldest hot row
+    # in that snapshot is already in an archive, since rows are archived
+    # before they leave the hot table. Returns [(path, row count), ...].
+    if fmt not in FORMATS:
+        raise ValueError(f'unknown format {fmt!r}')
+    transactions_path = os.path.join(directory, f'transactions.{fmt}.gz')
+    accounts_path = os.path.join(directory, f'accounts.{fmt}.gz')
+    bounds = (since, until, from_id, to_id)
+    conn.execute('BEGIN')
+    try:
+        oldest = conn.execute('SELECT MIN(id) FROM transactions').fetchone()[0]
+        rows = _iter_transactions(conn, *bounds)
+        if archive_dir is not None:
+            rows = chain(_iter_archived(archive_paths(archive_dir), oldest, *bounds), rows)
+        transactions = _write_rows(transactions_path, TRANSACTION_COLUMNS, rows, fmt)
+        accounts = _write_rows(accounts_path, ACCOUNT_COLUMNS, _iter_accounts(conn), fmt)
+    finally:
+        conn.execute('COMMIT')
+    return [(transactions_path, transactions), (accounts_path, accounts)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dump the SevenX ledger as gzip-compressed CSV or JSONL')
+    parser.add_argument('--db', default='7x_currency.db')
+    parser.add_argument('--archive-dir', default='archive', help='directory of the monthly transaction archives')
+    parser.add_argument('--out', default='.', help='directory to write the files to')
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--since', type=parse_time, help='first timestamp to include')
+    parser.add_argument('--until', type=parse_time, help='first timestamp to leave out')
+    parser.add_argument('--from-id', type=int, help='first transaction id to include')
+    parser.add_argument('--to-id', type=int, help='last transaction id to include')
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    # Read-only, so it is safe to run next to the bot
+    conn = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True, isolation_level=None)
+    try:
+        files = write_dump(conn, args.out, args.format, args.since, args.until, args.from_id, args.to_id, args.archive_dir)
+    finally:
+        conn.close()
+    for path, count in files:
+        print(f'{path}: {count} rows')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import os
+import time
+
+from ledger import SYSTEM_ID, SYSTEM_NAME
+
+logger = logging.getLogger(__name__)
+
+
+def _format_transaction(sender, receiver, amount, timestamp):
+    return f'{sender} -> {receiver}: {amount} SevenX at {timestamp}\n'
+
+def _read_state(path):
+    # The state file holds the last exported transaction id and the size of
+    # transactions.txt right after it was written.
+    try:
+        with open(path) as f:
+            last_id, offset = f.read().split()
+        return int(last_id), int(offset)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _write_atomic(path, text):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _append_transactions(conn, path, state_path):
+    state = _read_state(state_path)
+    if state is None or not os.path.exists(path) or os.path.getsize(path) < state[1]:
+        # No usable high-water mark, rebuild the file from the first row
+        last_id, mode = 0, 'w'
+    else:
+        last_id, offset = state
+        # Drop anything appended after the last recorded state (e.g. a crash mid-write)
+        with open(path, 'r+') as f:
+            f.truncate(offset)
+        mode = 'a'
+
+    rows = conn.execute(f'''
+        SELECT t.id, COALESCE(s.username, NULLIF(t.sender_id, {SYSTEM_ID}), '{SYSTEM_NAME}'),
+               COALESCE(r.username, NULLIF(t.receiver_id, {SYSTEM_ID}), '{SYSTEM_NAME}'), t.amount, t.timestamp
+        FROM transactions t
+        LEFT JOIN accounts s ON s.user_id = t.sender_id
+        LEFT JOIN accounts r ON r.user_id = t.receiver_id
+        WHERE t.id > ?
+        ORDER BY t.id
+    ''', (last_id,))
+    with open(path, mode) as f:
+        for row_id, sender, receiver, amount, timestamp in rows:
+            f.write(_format_transaction(sender, receiver, amount, timestamp))
+            last_id = row_id
+        f.flush()
+        os.fsync(f.fileno())
+        offset = f.tell()
+    _write_atomic(state_path, f'{last_id} {offset}\n')
+
+def _snapshot_balances(conn, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        for username, balance in conn.execute('SELECT COALESCE(username, user_id), balance FROM accounts'):
+            f.write(f'{username}: {balance} SevenX\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Exporter:
+    # Keeps balances.txt and transactions.txt in step with the ledger without
+    # rewriting them on every commit. Changes are batched for `interval`
+    # seconds; new transactions are appended past a high-water mark kept in
+    # `<transactions_path>.hwm`, and balances.txt is replaced atomically.
+
+    def __init__(self, ledger, interval=5.0, balances_path='balances.txt', transactions_path='transactions.txt'):
+        self.ledger = ledger
+        self.interval = interval
+        self.balances_path = balances_path
+        self.transactions_path = transactions_path
+        self.state_path = transactions_path + '.hwm'
+        # Start dirty to catch up on anything written while we were down
+        self._balances_dirty = True
+        self._transactions_dirty = True
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        self._stopping = asyncio.Event()
+        self._task = None
+        self.observe_export = None  # fn(name, seconds) per file written
+        ledger.add_listener(self.on_change)
+
+    def exported_id(self):
+        # Id of the last transaction written to transactions.txt, 0 if none
+        state = _read_state(self.state_path)
+        return state[0] if state else 0
+
+    def on_change(self, tables, balances):
+        if 'accounts' in tables:
+            self._balances_dirty = True
+        if 'transactions' in tables:
+            self._transactions_dirty = True
+        self._wakeup.set()
+
+    async def _export(self, name, fn, *args):
+        if self.observe_export is None:
+            return await self.ledger.read(fn, *args)
+        start = time.perf_counter()
+        try:
+            return await self.ledger.read(fn, *args)
+        finally:
+            self.observe_export(name, time.perf_counter() - start)
+
+    async def flush(self):
+        if self._transactions_dirty:
+            self._transactions_dirty = False
+            try:
+                await self._export('transactions', _append_transactions, self.transactions_path, self.state_path)
+            except Exception:
+                self._transactions_dirty = True
+                raise
+        if self._balances_dirty:
+            self._balances_dirty = False
+            try:
+                await self._export('balances', _snapshot_balances, self.balances_path)
+            except Exception:
+                self._balances_dirty = True
+                raise
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            await self._wakeup.wait()
+            # Debounce: let more changes pile up unless we are shutting down
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Export failed, retrying on the next change')
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        # Final flush happens inside the task so it never overlaps a running one
+        self._stopping.set()
+        self._wakeup.set()
+        if self._task:
+            await self._task
+            self._task = None
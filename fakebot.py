@@ -0,0 +1,60 @@
+import asyncio
+import itertools
+import time
+from types import SimpleNamespace
+
+from telegram.error import RetryAfter
+
+
+class FakeBot:
+    # Stand-in for telegram.Bot when exercising the bot offline. Every call
+    # is recorded in `calls` as (method, kwargs, monotonic time). With
+    # `flood_every=n`, every n-th call raises RetryAfter(`retry_after`) the
+    # way Telegram answers a 429. `latency` adds a simulated round trip.
+
+    def __init__(self, latency=0.0, flood_every=0, retry_after=1):
+        self.latency = latency
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.calls = []
+        self.last_message = {}  # chat_id -> kwargs of the last message sent there
+        self.floods = 0
+        self._attempts = 0
+        self._message_ids = itertools.count(1)
+
+    async def _call(self, method, kwargs):
+        self._attempts += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_every and self._attempts % self.flood_every == 0:
+            self.floods += 1
+            raise RetryAfter(self.retry_after)
+        self.calls.append((method, kwargs, time.monotonic()))
+
+    def calls_to(self, method):
+        return [kwargs for name, kwargs, _ in self.calls if name == method]
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.last_message[chat_id] = dict(kwargs, chat_id=chat_id, text=text)
+        await self._call('send_message', self.last_message[chat_id])
+        return SimpleNamespace(chat_id=chat_id, message_id=next(self._message_ids), text=text)
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await self._call('delete_message', dict(kwargs, chat_id=chat_id, message_id=message_id))
+        return True
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await self._call('edit_message_text', dict(kwargs, chat_id=chat_id, message_id=message_id, text=text))
+        return True
+
+    async def edit_message_reply_markup(self, chat_id=None, message_id=None, **kwargs):
+        await self._call('edit_message_reply_markup', dict(kwargs, chat_id=chat_id, message_id=message_id))
+        return True
+
+    async def send_document(self, chat_id, document, **kwargs):
+        await self._call('send_document', dict(kwargs, chat_id=chat_id, document=document))
+        return SimpleNamespace(chat_id=chat_id, message_id=next(self._message_ids))
+
+    async def answer_callback_query(self, callback_query_id, **kwargs):
+        await self._call('answer_callback_query', dict(kwargs, callback_query_id=callback_query_id))
+        return True
@@ -0,0 +1,65 @@
+from bisect import bisect_left, insort
+
+
+def _load_balances(conn):
+    # Walks idx_accounts_balance, no sort needed
+    return conn.execute('SELECT user_id, balance FROM accounts ORDER BY balance DESC').fetchall()
+
+
+class Leaderboard:
+    # Every account's balance kept in a list sorted by (-balance, user_id),
+    # updated from committed balance changes. Top-N is a slice and a rank is
+    # a binary search, so neither touches SQLite nor scans all users.
+
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self.ready = False
+        self._balances = {}
+        self._order = []
+        ledger.add_listener(self.on_change)
+
+    async def load(self):
+        rows = await self.ledger.read(_load_balances)
+        self._balances = dict(rows)
+        self._order = sorted((-balance, user_id) for user_id, balance in rows)
+        self.ready = True
+
+    def on_change(self, tables, balances):
+        if not self.ready:
+            return
+        if len(balances) > 64 and len(balances) * 8 > len(self._order):
+            # Bulk change (e.g. an airdrop): one sort beats many list inserts
+            self._balances.update(balances)
+            for user_id in [user_id for user_id, balance in balances.items() if balance is None]:
+                del self._balances[user_id]
+            self._order = sorted((-balance, user_id) for user_id, balance in self._balances.items())
+            return
+        for user_id, balance in balances.items():
+            self.update(user_id, balance)
+
+    def update(self, user_id, balance):
+        # A balance of None removes the account
+        old = self._balances.get(user_id)
+        if old == balance:
+            return
+        if old is not None:
+            del self._order[bisect_left(self._order, (-old, user_id))]
+        if balance is None:
+            self._balances.pop(user_id, None)
+            return
+        self._balances[user_id] = balance
+        insort(self._order, (-balance, user_id))
+
+    def __len__(self):
+        return len(self._order)
+
+    def top(self, n=10):
+        # (user_id, balance) pairs
+        return [(user_id, -balance) for balance, user_id in self._order[:n]]
+
+    def rank(self, user_id):
+        # 1 + number of accounts with a strictly higher balance; None if unknown
+        balance = self._balances.get(user_id)
+        if balance is None:
+            return None
+        return bisect_left(self._order, (-balance, float('-inf'))) + 1
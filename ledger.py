@@ -0,0 +1,566 @@
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from archive import archive_paths, attached
+from cache import MISSING, LRUCache
+from migrate import CHUNK_SIZE, migrate
+
+logger = logging.getLogger(__name__)
+
+# The other side of mints and claims (sender) and burns (receiver). No
+# account has this id; its balance on the ledger is minus the total supply.
+SYSTEM_ID = 0
+SYSTEM_NAME = 'SevenX'
+
+SCHEMA = [
+    # One row per Telegram user, keyed by their numeric id. The INTEGER
+    # PRIMARY KEY is the rowid, so rows are already clustered by user id and
+    # WITHOUT ROWID would buy nothing. Accounts known only by username (paid
+    # before their owner ever talked to the bot) get a provisional negative
+    # id until the owner shows up; see accounts.py.
+    '''
+    CREATE TABLE IF NOT EXISTS accounts (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        chat_id INTEGER,
+        balance INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_id INTEGER,
+        receiver_id INTEGER,
+        amount INTEGER,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS pending_transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_id INTEGER,
+        receiver TEXT,
+        amount INTEGER,
+        created_at REAL,
+        chat_id INTEGER,
+        message_id INTEGER
+    )
+    ''',
+    # Provisional accounts that were handed to their real owner
+    '''
+    CREATE TABLE IF NOT EXISTS merged_accounts (
+        old_id INTEGER PRIMARY KEY,
+        new_id INTEGER NOT NULL
+    )
+    ''',
+    # Materialized SUM(accounts.balance)
+    '''
+    CREATE TABLE IF NOT EXISTS supply (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        total INTEGER NOT NULL
+    )
+    ''',
+    # Sparse balance checkpoints, see reconcile.py
+    '''
+    CREATE TABLE IF NOT EXISTS checkpoints (
+        id INTEGER PRIMARY KEY,
+        tx_id INTEGER NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS checkpoint_balances (
+        user_id INTEGER,
+        checkpoint_id INTEGER,
+        balance INTEGER NOT NULL,
+        PRIMARY KEY (user_id, checkpoint_id)
+    ) WITHOUT ROWID
+    ''',
+]
+
+# Columns added after a table was first released: (table, column, type)
+COLUMNS = [
+    ('pending_transactions', 'created_at', 'REAL'),
+    ('pending_transactions', 'chat_id', 'INTEGER'),
+    ('pending_transactions', 'message_id', 'INTEGER'),
+    ('pending_transactions', 'sender_id', 'INTEGER'),
+    ('transactions', 'sender_id', 'INTEGER'),
+    ('transactions', 'receiver_id', 'INTEGER'),
+]
+
+# Created once any migration has run, as they refer to the new columns
+INDEXES = [
+    # Seeded once from the accounts table
+    'INSERT OR IGNORE INTO supply (id, total) SELECT 0, COALESCE(SUM(balance), 0) FROM accounts',
+    # /pay and /lookup resolve usernames; Telegram usernames are unique
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_accounts_username ON accounts (username)',
+    # Covering index for balance-ordered reads (leaderboard load and /top fallback)
+    'CREATE INDEX IF NOT EXISTS idx_accounts_balance ON accounts (balance, user_id)',
+    # Per-user history: each side of a user's transfers is one index range
+    'CREATE INDEX IF NOT EXISTS idx_transactions_sender_id ON transactions (sender_id, id)',
+    'CREATE INDEX IF NOT EXISTS idx_transactions_receiver_id ON transactions (receiver_id, id)',
+]
+
+def _create_schema(conn, archive_dir=None, chunk_size=CHUNK_SIZE):
+    for statement in SCHEMA:
+        conn.execute(statement)
+    for table, column, kind in COLUMNS:
+        existing = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+        if column not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {kind}')
+    conn.commit()
+    migrate(conn, archive_dir, chunk_size)
+    for statement in INDEXES:
+        conn.execute(statement)
+
+
+# Queries. Each one takes the connection of the thread it runs on.
+def _find_balance(conn, user_id):
+    result = conn.execute('SELECT balance FROM accounts WHERE user_id = ?', (user_id,)).fetchone()
+    return result[0] if result else None
+
+def _credit(conn, user_id, amount):
+    # Returns the new balance so the caller can write it through to the cache
+    return conn.execute('''
+        INSERT INTO accounts (user_id, balance) VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance
+        RETURNING balance
+    ''', (user_id, amount)).fetchone()[0]
+
+def _current_id(conn, user_id):
+    # A provisional id resolved before its account was merged still has to
+    # reach the account it was merged into
+    if user_id >= 0:
+        return user_id
+    result = conn.execute('SELECT new_id FROM merged_accounts WHERE old_id = ?', (user_id,)).fetchone()
+    return result[0] if result else user_id
+
+def _update_balance(conn, user_id, amount):
+    # Mint, burn or claim: money enters or leaves circulation, and goes on
+    # the ledger like any transfer with SYSTEM_ID on the other side
+    conn.execute('UPDATE supply SET total = total + ? WHERE id = 0', (amount,))
+    if amount >= 0:
+        _record_transaction(conn, SYSTEM_ID, user_id, amount)
+    else:
+        _record_transaction(conn, user_id, SYSTEM_ID, -amount)
+    return _credit(conn, user_id, amount)
+
+def _record_transaction(conn, sender_id, receiver_id, amount):
+    conn.execute('INSERT INTO transactions (sender_id, receiver_id, amount) VALUES (?, ?, ?)', (sender_id, receiver_id, amount))
+
+def _get_total_supply(conn):
+    return conn.execute('SELECT total FROM supply WHERE id = 0').fetchone()[0]
+
+def _verify_supply(conn):
+    # Full scan; returns (materialized total, actual sum of balances)
+    return conn.execute('SELECT (SELECT total FROM supply WHERE id = 0), COALESCE(SUM(balance), 0) FROM accounts').fetchone()
+
+def _get_top_users(conn, limit):
+    return conn.execute('SELECT COALESCE(username, user_id), balance FROM accounts ORDER BY balance DESC LIMIT ?', (limit,)).fetchall()
+
+def _get_transactions(conn, limit, before_id, archive_dir=None):
+    # Keyset paging on the INTEGER PRIMARY KEY: a range scan of the rowid
+    # b-tree, so every page costs the same however deep it is. A page that
+    # runs past the oldest hot row is filled up from the archives.
+    rows = _get_transactions_from(conn, 'main', limit, before_id)
+    if archive_dir is None:
+        return rows
+    for path in reversed(archive_paths(archive_dir)):
+        if len(rows) >= limit:
+            break
+        with attached(conn, path) as schema:
+            rows += _get_transactions_from(conn, schema, limit - len(rows), rows[-1][0] if rows else before_id)
+    return rows
+
+def _get_transactions_from(conn, schema, limit, before_id):
+    # (id, sender, receiver, amount, timestamp) with usernames, or the user
+    # id for accounts without one
+    return conn.execute(f'''
+        SELECT t.id, COALESCE(s.username, NULLIF(t.sender_id, {SYSTEM_ID}), '{SYSTEM_NAME}'),
+               COALESCE(r.username, NULLIF(t.receiver_id, {SYSTEM_ID}), '{SYSTEM_NAME}'), t.amount, t.timestamp
+        FROM {schema}.transactions t
+        LEFT JOIN main.accounts s ON s.user_id = t.sender_id
+        LEFT JOIN main.accounts r ON r.user_id = t.receiver_id
+        WHERE t.id < ?
+        ORDER BY t.id DESC
+        LIMIT ?
+    ''', (before_id if before_id is not None else 2 ** 63 - 1, limit)).fetchall()
+
+def balance_before(user_id, row):
+    # The user's balance just before a _get_history row
+    _, sender_id, receiver_id, amount, _, balance = row[:6]
+    return balance + (amount if sender_id == user_id else 0) - (amount if receiver_id == user_id else 0)
+
+def _get_history(conn, user_id, limit, before_id, balance, archive_dir=None):
+    # A user's transfers, newest first, each with the user's balance right
+    # after it, carried on into the archives like _get_transactions.
+    rows = _get_history_from(conn, 'main', user_id, limit, before_id, balance)
+    if archive_dir is None or len(rows) >= limit:
+        return rows
+    paths = archive_paths(archive_dir)
+    if not paths:
+        return rows
+    if rows:
+        before_id, balance = rows[-1][0], balance_before(user_id, rows[-1])
+    elif balance is None:
+        # Starting inside the archives without a cursor balance: take back
+        # everything the user did from `before_id` on, hot and archived
+        balance = (_find_balance(conn, user_id) or 0) - _net_change(conn, 'main', user_id, before_id)
+        for path in paths:
+            with attached(conn, path) as schema:
+                balance -= _net_change(conn, schema, user_id, before_id)
+    for path in reversed(paths):
+        with attached(conn, path) as schema:
+            found = _get_history_from(conn, schema, user_id, limit - len(rows), before_id, balance)
+        if found:
+            rows += found
+            before_id, balance = rows[-1][0], balance_before(user_id, rows[-1])
+        if len(rows) >= limit:
+            break
+    return rows
+
+def _net_change(conn, schema, user_id, since_id):
+    # What the user received minus what they sent from `since_id` on
+    if since_id is None:
+        return 0
+    return conn.execute(f'''
+        SELECT (SELECT COALESCE(SUM(amount), 0) FROM {schema}.transactions WHERE receiver_id = :user AND id >= :since)
+             - (SELECT COALESCE(SUM(amount), 0) FROM {schema}.transactions WHERE sender_id = :user AND id >= :since)
+    ''', {'user': user_id, 'since': since_id}).fetchone()[0]
+
+def _get_history_from(conn, schema, user_id, limit, before_id, balance):
+    # Rows are (id, sender_id, receiver_id, amount, timestamp, balance after,
+    # sender name, receiver name). Both sides of a user's transfers are read
+    # newest-first from their own index and merged, so a page costs two
+    # short range scans at any depth.
+    #
+    # `balance` is the balance after the newest row of the page (the value
+    # a previous page handed out with its cursor). Without it, it is worked
+    # out from the current balance and everything newer than `before_id`,
+    # in the same statement so the two agree.
+    return conn.execute(f'''
+        WITH page AS (
+            SELECT * FROM (SELECT id, sender_id, receiver_id, amount, timestamp FROM {schema}.transactions
+                           WHERE sender_id = :user AND id < :before ORDER BY id DESC LIMIT :limit)
+            UNION
+            SELECT * FROM (SELECT id, sender_id, receiver_id, amount, timestamp FROM {schema}.transactions
+                           WHERE receiver_id = :user AND id < :before ORDER BY id DESC LIMIT :limit)
+        ),
+        start AS (
+            SELECT COALESCE(:balance,
+                            COALESCE((SELECT balance FROM main.accounts WHERE user_id = :user), 0)
+                            - (SELECT COALESCE(SUM(amount), 0) FROM {schema}.transactions WHERE receiver_id = :user AND id >= :before)
+                            + (SELECT COALESCE(SUM(amount), 0) FROM {schema}.transactions WHERE sender_id = :user AND id >= :before)) AS balance
+        )
+        SELECT p.id, p.sender_id, p.receiver_id, p.amount, p.timestamp,
+               (SELECT balance FROM start) - COALESCE(SUM(
+                   CASE WHEN p.receiver_id = :user THEN p.amount ELSE 0 END - CASE WHEN p.sender_id = :user THEN p.amount ELSE 0 END
+               ) OVER (ORDER BY p.id DESC ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0) AS balance,
+               COALESCE(s.username, NULLIF(p.sender_id, {SYSTEM_ID}), '{SYSTEM_NAME}'),
+               COALESCE(r.username, NULLIF(p.receiver_id, {SYSTEM_ID}), '{SYSTEM_NAME}')
+        FROM page p
+        LEFT JOIN main.accounts s ON s.user_id = p.sender_id
+        LEFT JOIN main.accounts r ON r.user_id = p.receiver_id
+        ORDER BY p.id DESC
+        LIMIT :limit
+    ''', {'user': user_id, 'limit': limit, 'before': before_id if before_id is not None else 2 ** 63 - 1,
+          'balance': balance}).fetchall()
+
+class InsufficientFunds(Exception):
+    pass
+
+def _transfer(conn, sender_id, receiver_id, amount):
+    # Debit, credit and ledger row, all inside the caller's transaction.
+    # Returns the new balances of both accounts.
+    if amount <= 0:
+        # A negative amount would pass the balance check and pull money the other way
+        raise ValueError(f'transfer amount must be positive, got {amount}')
+    debited = conn.execute('UPDATE accounts SET balance = balance - ? WHERE user_id = ? AND balance >= ? RETURNING balance',
+                           (amount, sender_id, amount)).fetchone()
+    if debited is None:
+        raise InsufficientFunds(sender_id)
+    balances = {sender_id: debited[0]}
+    receiver_id = _current_id(conn, receiver_id)
+    balances[receiver_id] = _credit(conn, receiver_id, amount)
+    _record_transaction(conn, sender_id, receiver_id, amount)
+    return balances
+
+def _bulk_transfer(conn, sender_id, payouts):
+    # payouts maps receiver id -> amount. One debit, then executemany for the
+    # credits and ledger rows. Returns the new balances of everyone involved.
+    if any(amount <= 0 for amount in payouts.values()):
+        raise ValueError('transfer amounts must be positive')
+    total = sum(payouts.values())
+    debited = conn.execute('UPDATE accounts SET balance = balance - ? WHERE user_id = ? AND balance >= ? RETURNING balance',
+                           (total, sender_id, total)).fetchone()
+    if debited is None:
+        raise InsufficientFunds(sender_id)
+    if any(receiver_id < 0 for receiver_id in payouts):
+        redirected = {}
+        for receiver_id, amount in payouts.items():
+            receiver_id = _current_id(conn, receiver_id)
+            redirected[receiver_id] = redirected.get(receiver_id, 0) + amount
+        payouts = redirected
+    conn.executemany('''
+        INSERT INTO accounts (user_id, balance) VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance
+    ''', payouts.items())
+    conn.executemany('INSERT INTO transactions (sender_id, receiver_id, amount) VALUES (?, ?, ?)',
+                     ((sender_id, receiver_id, amount) for receiver_id, amount in payouts.items()))
+
+    balances = {}
+    receivers = list(payouts)
+    for i in range(0, len(receivers), 500):
+        chunk = receivers[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        balances.update(conn.execute(f'SELECT user_id, balance FROM accounts WHERE user_id IN ({placeholders})', chunk))
+    balances[sender_id] = balances.get(sender_id, debited[0])
+    return balances
+
+def _timed(observe, fn, conn, args):
+    start = time.perf_counter()
+    try:
+        return fn(conn, *args)
+    finally:
+        observe(fn.__name__, time.perf_counter() - start)
+
+
+class GroupCommitWriter:
+    # Runs write operations on one thread and commits them in batches. Every
+    # operation gets its own savepoint, so a failing one is rolled back alone
+    # while the rest of the batch shares a single COMMIT (and a single fsync).
+    # Operations that arrive while a commit is in flight, or within `window`
+    # seconds of the first one, are coalesced into the next batch.
+
+    def __init__(self, connect, window=0.002, max_batch=256):
+        self._connect = connect
+        self.window = window
+        self.max_batch = max_batch
+        self.observe_query = None   # fn(name, seconds) per operation
+        self.observe_commit = None  # fn(batch_size, seconds) per commit
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='ledger-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, args):
+        future = Future()
+        self._queue.put((fn, args, future))
+        return future
+
+    def shutdown(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            try:
+                self._commit(conn, batch)
+            except Exception:
+                # Never let the thread die, or every later write would hang
+                logger.exception('Ledger writer failed on a batch of %d', len(batch))
+
+    def _commit(self, conn, batch):
+        results = []
+        started = []
+        reached = 0
+        try:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')  # left open by a rollback that failed
+            conn.execute('BEGIN IMMEDIATE')
+            for fn, args, future in batch:
+                reached += 1
+                if not future.set_running_or_notify_cancel():
+                    continue
+                started.append(future)
+                conn.execute('SAVEPOINT op')
+                try:
+                    if self.observe_query is None:
+                        result = fn(conn, *args)
+                    else:
+                        result = _timed(self.observe_query, fn, conn, args)
+                    results.append((future, result, None))
+                except Exception as e:
+                    conn.execute('ROLLBACK TO op')
+                    results.append((future, None, e))
+                conn.execute('RELEASE op')
+            start = time.perf_counter()
+            conn.execute('COMMIT')
+            elapsed = time.perf_counter() - start
+        except Exception as e:
+            # BEGIN, a savepoint or COMMIT failed: nothing of the batch is
+            # kept. Operations cancelled before they were reached stay
+            # cancelled, the rest fail with the error.
+            try:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+            finally:
+                for future in started:
+                    future.set_exception(e)
+                for _, _, future in batch[reached:]:
+                    if future.set_running_or_notify_cancel():
+                        future.set_exception(e)
+            return
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        if self.observe_commit is not None:
+            self.observe_commit(len(batch), elapsed)
+
+
+class Ledger:
+    # SQLite access for the bot, kept off the event loop. Writes are
+    # serialized on a single writer thread; reads run on a small pool of
+    # reader threads. Every thread owns its connection and the database
+    # runs in WAL mode, so readers never wait for a commit in progress.
+
+    def __init__(self, path, readers=4, commit_window=0.002, cache_size=10000, archive_dir=None):
+        self.path = path
+        self.archive_dir = archive_dir
+        self.cache = LRUCache(cache_size)
+        self.observe_query = None
+        self.trace = None  # fn(name, op) -> context manager around each awaited read/write, see tracing.py
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='ledger-reader')
+        self._listeners = []
+
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        _create_schema(conn, archive_dir)
+        conn.commit()
+        conn.close()
+
+        self._writer = GroupCommitWriter(lambda: self._connection(readonly=False), window=commit_window)
+
+    def _connection(self, readonly):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA busy_timeout=5000')
+            if readonly:
+                conn.execute('PRAGMA query_only=ON')
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def observe(self, query=None, commit=None):
+        # Optional timing hooks: query(name, seconds) for every query and
+        # write operation, commit(batch_size, seconds) for every commit
+        self.observe_query = query
+        self._writer.observe_query = query
+        self._writer.observe_commit = commit
+
+    def _run_read(self, fn, args):
+        if self.observe_query is None:
+            return fn(self._connection(readonly=True), *args)
+        return _timed(self.observe_query, fn, self._connection(readonly=True), args)
+
+    async def read(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        if self.trace is None:
+            return await loop.run_in_executor(self._readers, self._run_read, fn, args)
+        with self.trace('db.read', fn.__name__):
+            return await loop.run_in_executor(self._readers, self._run_read, fn, args)
+
+    async def write(self, fn, *args):
+        if self.trace is None:
+            return await asyncio.wrap_future(self._writer.submit(fn, args))
+        with self.trace('db.write', fn.__name__):
+            return await asyncio.wrap_future(self._writer.submit(fn, args))
+
+    def add_listener(self, fn):
+        # fn(tables, balances) is called on the event loop after each commit
+        # that changed `tables`; `balances` maps user ids to their new balance,
+        # or to None for an account that was merged into another one.
+        self._listeners.append(fn)
+
+    def changed(self, tables, balances=None):
+        balances = balances or {}
+        for user_id, balance in balances.items():
+            self.cache.put(user_id, balance)
+        for fn in self._listeners:
+            fn(tables, balances)
+
+    def close(self):
+        self._writer.shutdown()
+        self._readers.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+    # Awaitable helpers used by the command handlers. Accounts are user ids.
+    async def get_balance(self, user_id):
+        balance = await self.find_balance(user_id)
+        return balance if balance is not None else 0
+
+    async def find_balance(self, user_id):
+        # None if the user has no account
+        balance = self.cache.get(user_id)
+        if balance is not MISSING:
+            return balance
+        generation = self.cache.generation
+        balance = await self.read(_find_balance, user_id)
+        self.cache.fill(user_id, balance, generation)
+        return balance
+
+    async def update_balance(self, user_id, amount):
+        balance = await self.write(_update_balance, user_id, amount)
+        self.changed({'accounts', 'transactions'}, {user_id: balance})
+
+    async def transfer(self, sender_id, receiver_id, amount):
+        balances = await self.write(_transfer, sender_id, receiver_id, amount)
+        self.changed({'accounts', 'transactions'}, balances)
+
+    async def bulk_transfer(self, sender_id, payouts):
+        balances = await self.write(_bulk_transfer, sender_id, payouts)
+        self.changed({'accounts', 'transactions'}, balances)
+
+    async def get_total_supply(self):
+        return await self.read(_get_total_supply)
+
+    async def verify_supply(self):
+        return await self.read(_verify_supply)
+
+    async def get_top_users(self, limit=10):
+        # (name, balance) pairs
+        return await self.read(_get_top_users, limit)
+
+    async def get_transactions(self, limit=10, before_id=None):
+        # Newest first, starting below `before_id` (the last id of the previous page)
+        return await self.read(_get_transactions, limit, before_id, self.archive_dir)
+
+    async def get_history(self, user_id, limit=10, before_id=None, balance=None):
+        # See _get_history_from for the row layout; newest first
+        return await self.read(_get_history, user_id, limit, before_id, balance, self.archive_dir)
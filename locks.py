@@ -0,0 +1,74 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+
+class _Entry:
+    __slots__ = ('lock', 'users')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0  # holders plus waiters
+
+
+class AccountLocks:
+    # One asyncio.Lock per account, created on first use and dropped once
+    # nobody holds or waits for it, so idle accounts cost nothing.
+    #
+    # hold() takes the locks of every account an operation touches in
+    # sorted order. With a single global order two transfers can never
+    # wait on each other in a cycle, transfers between disjoint accounts
+    # run side by side, and ones sharing an account queue up in arrival
+    # order.
+
+    def __init__(self):
+        self.acquired = 0
+        self.contended = 0
+        self.wait_seconds = 0.0
+        self.observe_wait = None  # fn(seconds) for every acquisition that had to wait
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @asynccontextmanager
+    async def hold(self, *user_ids):
+        user_ids = sorted(set(user_ids))
+        entries = []
+        for user_id in user_ids:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                entry = self._entries[user_id] = _Entry()
+            entry.users += 1
+            entries.append(entry)
+
+        held = []
+        try:
+            contended = any(entry.lock.locked() for entry in entries)
+            start = time.monotonic()
+            for entry in entries:
+                await entry.lock.acquire()
+                held.append(entry)
+            self.acquired += 1
+            if contended:
+                waited = time.monotonic() - start
+                self.contended += 1
+                self.wait_seconds += waited
+                if self.observe_wait is not None:
+                    self.observe_wait(waited)
+            yield
+        finally:
+            for entry in reversed(held):
+                entry.lock.release()
+            for user_id, entry in zip(user_ids, entries):
+                entry.users -= 1
+                if entry.users == 0:
+                    del self._entries[user_id]
+
+    def stats(self):
+        return {
+            'accounts': len(self._entries),
+            'acquired': self.acquired,
+            'contended': self.contended,
+            'wait_seconds': self.wait_seconds,
+        }
@@ -1,141 +1,118 @@
-import sqlite3
+import asyncio
+import csv
+import functools
+import io
 import os
 import json
+import tempfile
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
-from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+
+import metrics
+from accounts import AccountRegistry
+from admission import Admission, load_limits
+from archive import Archiver
+from cache import MISSING, LRUCache
+from dump import FORMATS, parse_time, write_dump
+from exporter import Exporter
+from leaderboard import Leaderboard
+from ledger import InsufficientFunds, Ledger, balance_before
+from locks import AccountLocks
+from notifier import Notifier
+from pending import PendingStore
+from reconcile import Reconciler
+from tracing import Tracer
 
 # Load config
 with open('config.json', 'r') as config_file:
     config = json.load(config_file)
 
 # Database setup
-conn = sqlite3.connect('7x_currency.db')
-c = conn.cursor()
-
-# Create tables
-c.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        username TEXT PRIMARY KEY,
-        balance INTEGER DEFAULT 0
-    )
-''')
-c.execute('''
-    CREATE TABLE IF NOT EXISTS transactions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        sender TEXT,
-        receiver TEXT,
-        amount INTEGER,
-        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-    )
-''')
-c.execute('''
-    CREATE TABLE IF NOT EXISTS pending_transactions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        sender TEXT,
-        receiver TEXT,
-        amount INTEGER
-    )
-''')
-c.execute('''
-    CREATE TABLE IF NOT EXISTS user_chat_ids (
-        username TEXT PRIMARY KEY,
-        chat_id INTEGER
-    )
-''')
-conn.commit()
-
-# Helper functions
-def get_balance(username):
-    c.execute('SELECT balance FROM users WHERE username = ?', (username,))
-    result = c.fetchone()
-    return result[0] if result else 0
-
-def update_balance(username, amount):
-    if get_balance(username) == 0:
-        c.execute('INSERT INTO users (username, balance) VALUES (?, ?)', (username, amount))
-    else:
-        c.execute('UPDATE users SET balance = balance + ? WHERE username = ?', (amount, username))
-    conn.commit()
-    save_balances()
-
-def record_transaction(sender, receiver, amount):
-    c.execute('INSERT INTO transactions (sender, receiver, amount) VALUES (?, ?, ?)', (sender, receiver, amount))
-    conn.commit()
-    save_transactions()
-
-def store_pending_transaction(sender, receiver, amount):
-    c.execute('INSERT INTO pending_transactions (sender, receiver, amount) VALUES (?, ?, ?)', (sender, receiver, amount))
-    conn.commit()
-    return c.lastrowid
-
-def get_pending_transaction(trans_id):
-    c.execute('SELECT sender, receiver, amount FROM pending_transactions WHERE id = ?', (trans_id,))
-    return c.fetchone()
-
-def delete_pending_transaction(trans_id):
-    c.execute('DELETE FROM pending_transactions WHERE id = ?', (trans_id,))
-    conn.commit()
-
-def store_user_chat_id(username, chat_id):
-    c.execute('REPLACE INTO user_chat_ids (username, chat_id) VALUES (?, ?)', (username, chat_id))
-    conn.commit()
-
-def get_user_chat_id(username):
-    c.execute('SELECT chat_id FROM user_chat_ids WHERE username = ?', (username,))
-    result = c.fetchone()
-    return result[0] if result else None
-
-def save_balances():
-    with open('balances.txt', 'w') as f:
-        for row in c.execute('SELECT username, balance FROM users'):
-            f.write(f'{row[0]}: {row[1]} SevenX\n')
-
-def save_transactions():
-    with open('transactions.txt', 'w') as f:
-        for row in c.execute('SELECT sender, receiver, amount, timestamp FROM transactions'):
-            f.write(f'{row[0]} -> {row[1]}: {row[2]} SevenX at {row[3]}\n')
-
-def get_total_supply():
-    c.execute('SELECT SUM(balance) FROM users')
-    result = c.fetchone()
-    return result[0] if result[0] else 0
-
-def get_top_users(limit=10):
-    c.execute('SELECT username, balance FROM users ORDER BY balance DESC LIMIT ?', (limit,))
-    return c.fetchall()
-
-def get_transactions(limit=10, offset=0):
-    c.execute('SELECT sender, receiver, amount, timestamp FROM transactions ORDER BY timestamp DESC LIMIT ? OFFSET ?', (limit, offset))
-    return c.fetchall()
+ledger = Ledger('7x_currency.db',
+                commit_window=config.get('GROUP_COMMIT_WINDOW', 0.002),
+                cache_size=config.get('BALANCE_CACHE_SIZE', 10000),
+                archive_dir=config.get('ARCHIVE_DIR', 'archive'))
+exporter = Exporter(ledger, interval=config.get('EXPORT_INTERVAL', 5))
+leaderboard = Leaderboard(ledger)
+account_locks = AccountLocks()
+admission = Admission(load_limits(config.get('RATE_LIMITS')))
+accounts = AccountRegistry(ledger, interval=config.get('ACCOUNT_FLUSH_INTERVAL', 5),
+                           cache_size=config.get('USERNAME_CACHE_SIZE', 10000))
+notifier = Notifier(workers=config.get('NOTIFY_WORKERS', 4),
+                    global_rate=config.get('NOTIFY_GLOBAL_RATE', 30),
+                    chat_rate=config.get('NOTIFY_CHAT_RATE', 1))
+pending_payments = PendingStore(ledger, notifier,
+                                ttl=config.get('PENDING_TTL', 300),
+                                sweep_interval=config.get('PENDING_SWEEP_INTERVAL', 30))
+
+reconciler = Reconciler(ledger, interval=config.get('RECONCILE_INTERVAL', 600))
+
+# Traces a sample of updates (handler, ledger and Telegram calls) to a JSONL file
+tracer = None
+if config.get('TRACE_SAMPLE_RATE'):
+    tracer = Tracer(config.get('TRACE_FILE', 'trace.jsonl'), sample_rate=config['TRACE_SAMPLE_RATE'])
+    tracer.attach(ledger, notifier)
+
+# Transactions older than ARCHIVE_AFTER_DAYS move to monthly archive files
+archiver = None
+if config.get('ARCHIVE_AFTER_DAYS'):
+    archiver = Archiver(ledger, ledger.archive_dir,
+                        max_age_days=config['ARCHIVE_AFTER_DAYS'],
+                        interval=config.get('ARCHIVE_INTERVAL', 3600))
+    # Never archive what transactions.txt or the reconciler has not picked up yet
+    archiver.limit_id = lambda: min(exporter.exported_id(), reconciler.verified_id())
+
+# Telegram refuses bot uploads over 50 MB
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+
+# Rendered /explorer pages by cursor ('head' for the newest page). Appending a
+# transaction only changes the newest page; older pages only change when an
+# account merge (reported with a None balance) rewrites their rows or an
+# account's name changes. That only holds for cursors taken from "Load more"
+# buttons: a typed one may lie past the newest transaction, so those pages
+# are not cached.
+EXPLORER_PAGE_SIZE = 10
+explorer_pages = LRUCache(config.get('EXPLORER_CACHE_SIZE', 256))
+explorer_renders = {}
+
+def on_ledger_change(tables, balances):
+    if 'transactions' in tables and None not in balances.values():
+        # A new transaction only changes the newest page
+        explorer_pages.invalidate('head')
+    elif 'accounts' in tables:
+        # Merges and renames change the names on any page
+        explorer_pages.invalidate()
+
+ledger.add_listener(on_ledger_change)
 
 # Command handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    username = update.message.from_user.username
-    chat_id = update.message.chat_id
-    store_user_chat_id(username, chat_id)
+    user = update.message.from_user
+    await accounts.remember(user.id, user.username, update.message.chat_id)
     await update.message.reply_text('Welcome to the SevenX Currency Bot!')
 
 async def pay(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    username = update.message.from_user.username
-    chat_id = update.message.chat_id
-    store_user_chat_id(username, chat_id)
+    user = update.message.from_user
+    await accounts.remember(user.id, user.username, update.message.chat_id)
 
     if len(context.args) != 2:
         await update.message.reply_text('Usage: /pay <username> <amount>')
         return
 
-    sender = update.message.from_user.username
     receiver, amount = context.args
     receiver = receiver.lstrip('@')  # Eliminar el "@" si está presente
+    if not (amount.isascii() and amount.isdecimal()) or int(amount) <= 0:
+        await update.message.reply_text('The amount must be a positive whole number.')
+        return
     amount = int(amount)
 
-    if get_balance(sender) < amount:
+    if await ledger.get_balance(user.id) < amount:
         await update.message.reply_text('Insufficient balance!')
         return
 
-    trans_id = store_pending_transaction(sender, receiver, amount)
+    trans_id = pending_payments.add(user.id, receiver, amount)
     keyboard = [
         [
             InlineKeyboardButton("Confirm", callback_data=f'confirm_{trans_id}'),
@@ -144,8 +121,9 @@ async def pay(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await update.message.reply_text(f'Confirm payment of {amount} SevenX to {receiver}?',
-                                    reply_markup=reply_markup)
+    prompt = await update.message.reply_text(f'Confirm payment of {amount} SevenX to {receiver}?',
+                                             reply_markup=reply_markup)
+    pending_payments.attach(trans_id, prompt.chat_id, prompt.message_id)
 
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
@@ -155,75 +133,109 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     action = callback_data[0]
     trans_id = int(callback_data[1])
 
-    if action == 'confirm':
-        sender, receiver, amount = get_pending_transaction(trans_id)
-        update_balance(sender, -amount)
-        update_balance(receiver, amount)
-        record_transaction(sender, receiver, amount)
-        delete_pending_transaction(trans_id)
+    chat_id = query.message.chat_id
+    message_id = query.message.message_id
 
-        await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
-        await context.bot.send_message(chat_id=query.message.chat_id,
-                                       text=f'Payment of {amount} SevenX to {receiver} confirmed!\nTransaction details:\nSender: {sender}\nReceiver: {receiver}\nAmount: {amount} SevenX',
-                                       parse_mode=ParseMode.MARKDOWN)
+    pending = pending_payments.get(trans_id)
+    if pending is None:
+        notifier.edit_message_text(chat_id, message_id, 'This payment request has expired.')
+        return
+    if pending.sender_id != query.from_user.id:
+        # Only the payer can answer their own prompt
+        return
+    pending_payments.pop(trans_id)
+
+    if action == 'confirm':
+        sender_id, receiver, amount = pending.sender_id, pending.receiver, pending.amount
+        sender = query.from_user.username or sender_id
+        # Paying a name nobody has used the bot with yet opens a provisional
+        # account that its owner takes over on their first command
+        receiver_id = await accounts.resolve(receiver, create=True)
+        # The balance may have changed since /pay, so check it again while
+        # no other update can touch either account
+        async with account_locks.hold(sender_id, receiver_id):
+            try:
+                if await ledger.get_balance(sender_id) < amount:
+                    raise InsufficientFunds(sender_id)
+                await ledger.transfer(sender_id, receiver_id, amount)
+            except InsufficientFunds:
+                notifier.edit_message_text(chat_id, message_id, 'Insufficient balance!')
+                return
+
+        notifier.delete_message(chat_id, message_id)
+        notifier.send_message(chat_id,
+                              f'Payment of {amount} SevenX to {receiver} confirmed!\nTransaction details:\nSender: {sender}\nReceiver: {receiver}\nAmount: {amount} SevenX',
+                              parse_mode=ParseMode.MARKDOWN)
 
         # Send a message to the receiver
-        receiver_chat_id = get_user_chat_id(receiver)
+        receiver_chat_id = await accounts.get_chat_id(receiver_id)
         if receiver_chat_id:
-            await context.bot.send_message(chat_id=receiver_chat_id,
-                                           text=f'You have received a payment of {amount} SevenX from {sender}.\nTransaction details:\nSender: {sender}\nAmount: {amount} SevenX')
+            notifier.send_message(receiver_chat_id,
+                                  f'You have received a payment of {amount} SevenX from {sender}.\nTransaction details:\nSender: {sender}\nAmount: {amount} SevenX')
 
     elif action == 'cancel':
-        delete_pending_transaction(trans_id)
-        await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
-        await context.bot.send_message(chat_id=query.message.chat_id, text='Payment canceled!')
+        notifier.delete_message(chat_id, message_id)
+        notifier.send_message(chat_id, 'Payment canceled!')
 
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    username = update.message.from_user.username
-    chat_id = update.message.chat_id
-    store_user_chat_id(username, chat_id)
+    user = update.message.from_user
+    await accounts.remember(user.id, user.username, update.message.chat_id)
+
+    if context.args:
+        # /balance YYYY-MM-DD [HH:MM:SS], in UTC like the ledger
+        try:
+            when = parse_time(' '.join(context.args))
+        except ValueError:
+            await update.message.reply_text('Usage: /balance [YYYY-MM-DD [HH:MM:SS]]')
+            return
+        balance = await reconciler.balance_at(user.id, when)
+        if balance is None:
+            await update.message.reply_text('No balance history is available yet.')
+        else:
+            await update.message.reply_text(f'Your balance at {when} UTC was {balance} SevenX.')
+        return
 
-    balance = get_balance(username)
+    balance = await ledger.get_balance(user.id)
     await update.message.reply_text(f'Your balance is {balance} SevenX.')
 
 async def claim(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    username = update.message.from_user.username
-    chat_id = update.message.chat_id
-    store_user_chat_id(username, chat_id)
-
-    if get_balance(username) == 0:
-        update_balance(username, 50)
+    user = update.message.from_user
+    await accounts.remember(user.id, user.username, update.message.chat_id)
+
+    async with account_locks.hold(user.id):
+        claimed = await ledger.get_balance(user.id) == 0
+        if claimed:
+            await ledger.update_balance(user.id, 50)
+    if claimed:
         await update.message.reply_text('Claimed 50 SevenX!')
     else:
         await update.message.reply_text('You have already claimed your 50 SevenX!')
 
 async def request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    username = update.message.from_user.username
-    chat_id = update.message.chat_id
-    store_user_chat_id(username, chat_id)
+    user = update.message.from_user
+    await accounts.remember(user.id, user.username, update.message.chat_id)
 
     if len(context.args) != 2:
         await update.message.reply_text('Usage: /request <username> <amount>')
         return
 
-    requester = update.message.from_user.username
+    requester = user.username
     target, amount = context.args
     amount = int(amount)
 
     await context.bot.send_message(chat_id=update.effective_chat.id, text=f'This command is not longer working and will be removed in future versions of the bot')
 
 async def refresh_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    username = update.message.from_user.username
-    chat_id = update.message.chat_id
-    store_user_chat_id(username, chat_id)
+    user = update.message.from_user
+    await accounts.remember(user.id, user.username, update.message.chat_id)
 
     await update.message.reply_text('Balance refreshed!')
 
 async def mint(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    username = update.message.from_user.username
+    user = update.message.from_user
 
     # Check if the user is authorized
-    if username != config["AUTHORIZED_USER"]:
+    if user.username != config["AUTHORIZED_USER"]:
         await update.message.reply_text("You are not authorized to use this command.")
         return
 
@@ -232,14 +244,15 @@ async def mint(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     amount = int(context.args[0])
-    update_balance(username, amount)
+    async with account_locks.hold(user.id):
+        await ledger.update_balance(user.id, amount)
     await update.message.reply_text(f'Minted {amount} SevenX!')
 
 async def burn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    username = update.message.from_user.username
+    user = update.message.from_user
 
     # Check if the user is authorized
-    if username != config["AUTHORIZED_USER"]:
+    if user.username != config["AUTHORIZED_USER"]:
         await update.message.reply_text("You are not authorized to use this command.")
         return
 
@@ -248,88 +261,396 @@ async def burn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     amount = int(context.args[0])
-    update_balance(username, -amount)
+    async with account_locks.hold(user.id):
+        await ledger.update_balance(user.id, -amount)
     await update.message.reply_text(f'Burned {amount} SevenX!')
 
+def parse_payouts(entries, csv_file=False):
+    # entries are (username, amount) pairs as typed or read from a CSV file.
+    # Returns (payouts, errors); repeated usernames are added together.
+    # Only an uploaded file may start with a header row, one whose amount
+    # column is headed "amount".
+    payouts = {}
+    errors = []
+    for line, entry in enumerate(entries, start=1):
+        if not entry or not any(field.strip() for field in entry):
+            continue
+        if len(entry) != 2:
+            errors.append(f'{line}: expected user:amount')
+            continue
+        receiver, amount = entry[0].strip().lstrip('@'), entry[1].strip()
+        if not (amount.isascii() and amount.isdecimal()):
+            if csv_file and line == 1 and amount.lower() == 'amount':
+                continue  # CSV header row
+            errors.append(f'{line}: invalid amount {amount!r}')
+            continue
+        if not receiver or int(amount) <= 0:
+            errors.append(f'{line}: invalid entry {receiver}:{amount}')
+            continue
+        payouts[receiver] = payouts.get(receiver, 0) + int(amount)
+    return payouts, errors
+
+async def airdrop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    username = update.message.from_user.username
+
+    # Check if the user is authorized
+    if username != config["AUTHORIZED_USER"]:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    # Either /airdrop user:amount ... or a CSV file of username,amount sent with /airdrop as caption
+    csv_file = bool(update.message.document)
+    if csv_file:
+        file = await update.message.document.get_file()
+        data = await file.download_as_bytearray()
+        entries = list(csv.reader(io.StringIO(data.decode('utf-8-sig'))))
+    else:
+        entries = [arg.split(':', 1) for arg in context.args or []]
+    if not entries:
+        await update.message.reply_text("Usage: /airdrop <username>:<amount> ... (or send a CSV file with /airdrop as caption)")
+        return
+
+    payouts, errors = parse_payouts(entries, csv_file)
+    if errors:
+        await update.message.reply_text("Airdrop rejected, nothing was sent:\n" + '\n'.join(errors[:10]))
+        return
+    if not payouts:
+        await update.message.reply_text("No recipients found.")
+        return
+
+    total = sum(payouts.values())
+    payer = update.message.from_user.id
+    receiver_ids = await accounts.resolve_many(list(payouts), create=True)
+    payouts = {receiver_ids[receiver]: amount for receiver, amount in payouts.items()}
+    try:
+        # Only the payer is debited; credits cannot overdraw anyone
+        async with account_locks.hold(payer):
+            await ledger.bulk_transfer(payer, payouts)
+    except InsufficientFunds:
+        await update.message.reply_text(f'Insufficient balance! The airdrop needs {total} SevenX.')
+        return
+    await update.message.reply_text(f'Airdropped {total} SevenX to {len(payouts)} users.')
+
+    for receiver_id, chat_id in (await accounts.get_chat_ids(list(payouts))).items():
+        notifier.send_message(chat_id, f'You have received an airdrop of {payouts[receiver_id]} SevenX from {username}.')
+
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    username = update.message.from_user.username
+
+    # Check if the user is authorized
+    if username != config["AUTHORIZED_USER"]:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    # /export [csv|jsonl] [since=YYYY-MM-DD] [until=YYYY-MM-DD] [from=<id>] [to=<id>]
+    fmt, bounds = 'csv', {}
+    try:
+        for arg in context.args or []:
+            if arg in FORMATS:
+                fmt = arg
+                continue
+            key, value = arg.split('=', 1)
+            if key in ('since', 'until'):
+                bounds[key] = parse_time(value)
+            elif key in ('from', 'to'):
+                bounds[key + '_id'] = int(value)
+            else:
+                raise ValueError(key)
+    except ValueError:
+        await update.message.reply_text("Usage: /export [csv|jsonl] [since=YYYY-MM-DD] [until=YYYY-MM-DD] [from=<id>] [to=<id>]")
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = await ledger.read(write_dump, directory, fmt, bounds.get('since'), bounds.get('until'),
+                                  bounds.get('from_id'), bounds.get('to_id'), ledger.archive_dir)
+        for path, count in files:
+            if os.path.getsize(path) > MAX_DOCUMENT_SIZE:
+                await update.message.reply_text(f'{os.path.basename(path)} is too large to send, run dump.py on the server instead.')
+                continue
+            with open(path, 'rb') as f:
+                await update.message.reply_document(f, filename=os.path.basename(path), caption=f'{count} rows')
+
 async def lookup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if len(context.args) != 1:
         await update.message.reply_text("Usage: /lookup <username>")
         return
 
     username = context.args[0].lstrip('@')  # Eliminar el "@" si está presente
-    c.execute('SELECT balance FROM users WHERE username = ?', (username,))
-    result = c.fetchone()
+    user_id = await accounts.resolve(username)
+    balance = await ledger.find_balance(user_id) if user_id is not None else None
 
-    if result:
-        balance = result[0]
+    if balance is not None:
         await update.message.reply_text(f"User: {username}\nBalance: {balance} SevenX")
     else:
         await update.message.reply_text("User not found.")
 
 async def supply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    total_supply = get_total_supply()
+    if context.args and context.args[0] == 'verify':
+        # Recomputing the sum is a full scan, so keep it to the authorized user
+        if update.message.from_user.username != config["AUTHORIZED_USER"]:
+            await update.message.reply_text("You are not authorized to use this command.")
+            return
+        total_supply, actual = await ledger.verify_supply()
+        drift = total_supply - actual
+        if drift:
+            message = f'Supply drift detected: recorded {total_supply}, balances sum to {actual} ({drift:+}).'
+        else:
+            message = f'Supply verified: {total_supply} SevenX.'
+        if reconciler.drifted:
+            message += f'\n{len(reconciler.drifted)} accounts disagree with the ledger, see the log.'
+        await update.message.reply_text(message)
+        return
+
+    total_supply = await ledger.get_total_supply()
     await update.message.reply_text(f'Total supply of SevenX: {total_supply}.')
 
 async def top(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    top_users = get_top_users()
+    try:
+        limit = 10 if not context.args else max(1, min(int(context.args[0]), 50))
+    except ValueError:
+        await update.message.reply_text('Usage: /top [n]')
+        return
+    if leaderboard.ready:
+        top_users = leaderboard.top(limit)
+        names = await accounts.names([user_id for user_id, _ in top_users])
+        top_users = [(names[user_id], balance) for user_id, balance in top_users]
+    else:
+        top_users = await ledger.get_top_users(limit)
+
     if top_users:
         message = "Top users by balance:\n\n"
         for i, (username, balance) in enumerate(top_users, start=1):
             message += f"{i}. {username}: {balance} SevenX\n"
+
+        rank = leaderboard.rank(update.message.from_user.id) if leaderboard.ready else None
+        if rank is not None:
+            message += f"\nYou are #{rank:,} of {len(leaderboard):,}."
         await update.message.reply_text(message)
     else:
         await update.message.reply_text("No users found.")
 
+async def explorer_page(before_id=None):
+    key = before_id if before_id is not None else 'head'
+    page = explorer_pages.get(key)
+    if page is not MISSING:
+        return page
+    # Presses that miss together share one query
+    rendering = explorer_renders.get(key)
+    if rendering is None:
+        rendering = explorer_renders[key] = asyncio.ensure_future(render_explorer_page(before_id))
+        rendering.add_done_callback(functools.partial(finish_explorer_page, key, explorer_pages.generation))
+    return await asyncio.shield(rendering)
+
+def finish_explorer_page(key, generation, rendering):
+    del explorer_renders[key]
+    if not rendering.cancelled() and rendering.exception() is None:
+        explorer_pages.fill(key, rendering.result(), generation)
+
+async def render_explorer_page(before_id, limit=EXPLORER_PAGE_SIZE):
+    # One extra row tells us whether there is a next page to offer
+    transactions = await ledger.get_transactions(limit=limit + 1, before_id=before_id)
+    if not transactions:
+        return "No more transactions available.", None
+
+    message = "Recent transactions:\n\n"
+    for _, sender, receiver, amount, timestamp in transactions[:limit]:
+        message += f"{timestamp}: {sender} -> {receiver} | {amount} SevenX\n"
+
+    if len(transactions) <= limit:
+        return message, None
+
+    # Option to load more transactions, continuing after the last one shown
+    last_id = transactions[limit - 1][0]
+    keyboard = [
+        [InlineKeyboardButton("Load more", callback_data=f'explorer_{last_id}')]
+    ]
+    return message, InlineKeyboardMarkup(keyboard)
+
 async def explorer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    limit = 10
-    offset = 0 if not context.args else int(context.args[0])
-    
-    transactions = get_transactions(limit=limit, offset=offset)
-    
-    if transactions:
-        message = "Recent transactions:\n\n"
-        for sender, receiver, amount, timestamp in transactions:
-            message += f"{timestamp}: {sender} -> {receiver} | {amount} SevenX\n"
-        
-        # Option to load more transactions
-        keyboard = [
-            [InlineKeyboardButton("Load more", callback_data=f'explorer_{offset + limit}')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(message, reply_markup=reply_markup)
+    if context.args:
+        message, reply_markup = await render_explorer_page(int(context.args[0]))
     else:
-        await update.message.reply_text("No more transactions available.")
+        message, reply_markup = await explorer_page()
+    await update.message.reply_text(message, reply_markup=reply_markup)
 
 async def handle_explorer_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
 
     callback_data = query.data.split('_')
-    offset = int(callback_data[1])
+    before_id = int(callback_data[1])
+
+    # Turn the page in place rather than stacking up new messages. Telegram
+    # rejects an edit that changes nothing, e.g. a second press on a page
+    # that is already showing; it stores the text stripped.
+    message, reply_markup = await explorer_page(before_id)
+    if message.strip() == query.message.text and reply_markup == query.message.reply_markup:
+        return
+    notifier.edit_message_text(query.message.chat_id, query.message.message_id, message, reply_markup=reply_markup)
+
+async def history_page(user_id, before_id=None, balance=None, limit=10):
+    name = (await accounts.names([user_id]))[user_id]
+    transactions = await ledger.get_history(user_id, limit=limit + 1, before_id=before_id, balance=balance)
+    if not transactions:
+        return f"No more transactions for {name}.", None
+
+    message = f"History for {name}:\n\n"
+    for _, sender_id, _, amount, timestamp, balance_after, sender, receiver in transactions[:limit]:
+        if sender_id == user_id:
+            message += f"{timestamp}: sent {amount} SevenX to {receiver} | balance {balance_after}\n"
+        else:
+            message += f"{timestamp}: received {amount} SevenX from {sender} | balance {balance_after}\n"
+
+    if len(transactions) <= limit:
+        return message, None
+
+    # The cursor carries the balance before the last row shown, which is the
+    # starting point of the next page. The balance is dropped if it would not
+    # fit in Telegram's 64-byte callback data and the next page works it out
+    # itself.
+    last_id = transactions[limit - 1][0]
+    callback_data = f'history_{last_id}_{balance_before(user_id, transactions[limit - 1])}_{user_id}'
+    if len(callback_data.encode()) > 64:
+        callback_data = f'history_{last_id}__{user_id}'
+    keyboard = [
+        [InlineKeyboardButton("Load more", callback_data=callback_data)]
+    ]
+    return message, InlineKeyboardMarkup(keyboard)
+
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.message.from_user
+    await accounts.remember(user.id, user.username, update.message.chat_id)
+
+    if len(context.args) > 1:
+        await update.message.reply_text("Usage: /history [username]")
+        return
+
+    user_id = await accounts.resolve(context.args[0].lstrip('@')) if context.args else user.id
+    if user_id is None:
+        await update.message.reply_text("User not found.")
+        return
+    message, reply_markup = await history_page(user_id)
+    await update.message.reply_text(message, reply_markup=reply_markup)
+
+async def handle_history_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
 
-    await explorer(update, context)
+    _, before_id, balance, user_id = query.data.split('_')
+    message, reply_markup = await history_page(int(user_id), int(before_id), int(balance) if balance else None)
+    await query.message.reply_text(message, reply_markup=reply_markup)
 
 
 # Main function
+metrics_server = None
+
+async def on_startup(application) -> None:
+    if tracer is not None:
+        tracer.start()
+    await leaderboard.load()
+    await pending_payments.load()
+    exporter.start()
+    accounts.start()
+    notifier.start(application.bot)
+    pending_payments.start()
+    reconciler.start()
+    if archiver is not None:
+        archiver.start()
+    global metrics_server
+    if metrics.enabled:
+        metrics_server = await metrics.serve(config["METRICS_PORT"])
+
+async def on_shutdown(application) -> None:
+    if metrics_server is not None:
+        metrics_server.close()
+    if archiver is not None:
+        await archiver.stop()
+    await reconciler.stop()
+    await pending_payments.stop()
+    await notifier.stop()
+    await accounts.stop()
+    await exporter.stop()
+    ledger.close()
+    if tracer is not None:
+        await tracer.stop()
+
+def setup_metrics():
+    metrics.enable(ledger, exporter, notifier, account_locks, admission)
+    metrics.Gauge('sevenx_balance_cache', 'Balance cache size and hit/miss counters', ledger.cache.stats, ('stat',))
+    metrics.Gauge('sevenx_username_cache', 'Username cache size and hit/miss counters', accounts.user_ids.stats, ('stat',))
+    metrics.Gauge('sevenx_explorer_cache', 'Explorer page cache size and hit/miss counters', explorer_pages.stats, ('stat',))
+    metrics.Gauge('sevenx_notify_queue_depth', 'Telegram calls waiting to be sent', lambda: notifier.depth)
+    metrics.Gauge('sevenx_notify_calls', 'Telegram calls sent, failed and retried', lambda: {
+        'sent': notifier.sent, 'failed': notifier.failed, 'retried': notifier.retried}, ('result',))
+    metrics.Gauge('sevenx_account_locks', 'Account lock acquisitions, contention and wait time', account_locks.stats, ('stat',))
+    metrics.Gauge('sevenx_admission', 'Per-user rate limit buckets and requests in flight', admission.stats, ('stat',))
+    metrics.Gauge('sevenx_pending_payments', 'Open /pay prompts', lambda: len(pending_payments))
+    metrics.Gauge('sevenx_pending_expired', 'Pay prompts expired since startup', lambda: pending_payments.expired)
+    metrics.Gauge('sevenx_reconcile', 'Latest checkpoint, accounts checked and accounts drifting from the ledger', reconciler.stats, ('stat',))
+    if archiver is not None:
+        metrics.Gauge('sevenx_archived_transactions', 'Transactions moved to the archive since startup', lambda: archiver.archived)
+
+async def dispatch_callback(routes, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Button presses are routed on the prefix of their callback data
+    query = update.callback_query
+    route = routes.get((query.data or '').split('_', 1)[0])
+    if route is None:
+        # A button left over from an older version of the bot
+        await query.answer()
+        return
+    await route(update, context)
+
+def handler(name, callback):
+    # Admission control runs first, so shed updates never reach the handler,
+    # its latency histogram or the trace
+    callback = metrics.instrument(name, callback)
+    if tracer is not None:
+        callback = tracer.instrument(name, callback)
+    return admission.guard(name, callback)
+
 def main():
     # Use config file for the bot token and authorized user
     TOKEN = config["TELEGRAM_BOT_TOKEN"]
-    application = ApplicationBuilder().token(TOKEN).build()
-
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("pay", pay))
-    application.add_handler(CommandHandler("balance", balance))
-    application.add_handler(CommandHandler("claim", claim))
-    application.add_handler(CommandHandler("request", request))
-    application.add_handler(CommandHandler("refresh", refresh_balance))
-    application.add_handler(CommandHandler("mint", mint))
-    application.add_handler(CommandHandler("burn", burn))
-    application.add_handler(CommandHandler("lookup", lookup))
-    application.add_handler(CommandHandler("supply", supply))
-    application.add_handler(CommandHandler("top", top))
-    application.add_handler(CommandHandler("explorer", explorer))
-    application.add_handler(CallbackQueryHandler(handle_callback))
-    application.add_handler(CallbackQueryHandler(handle_explorer_callback))
+    builder = (ApplicationBuilder().token(TOKEN)
+               .concurrent_updates(config.get("CONCURRENT_UPDATES", True))
+               .post_init(on_startup).post_shutdown(on_shutdown))
+    if tracer is not None:
+        builder = builder.request(tracer.request())
+    application = builder.build()
+
+    if config.get("METRICS_PORT"):
+        setup_metrics()
+
+    commands = {
+        "start": start,
+        "pay": pay,
+        "balance": balance,
+        "claim": claim,
+        "request": request,
+        "refresh": refresh_balance,
+        "mint": mint,
+        "burn": burn,
+        "airdrop": airdrop,
+        "export": export,
+        "lookup": lookup,
+        "supply": supply,
+        "top": top,
+        "explorer": explorer,
+        "history": history,
+    }
+    for name, callback in commands.items():
+        application.add_handler(CommandHandler(name, handler(name, callback)))
+    application.add_handler(MessageHandler(filters.Document.FileExtension("csv") & filters.CaptionRegex(r'^/airdrop'),
+                                           handler("airdrop", airdrop)))
+
+    payment_callback = handler("payment_callback", handle_callback)
+    routes = {
+        "confirm": payment_callback,
+        "cancel": payment_callback,
+        "explorer": handler("explorer_callback", handle_explorer_callback),
+        "history": handler("history_callback", handle_history_callback),
+    }
+    application.add_handler(CallbackQueryHandler(functools.partial(dispatch_callback, routes)))
 
     application.run_polling()
 
@@ -0,0 +1,193 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Minimal Prometheus instrumentation. Nothing is measured until enable() is
+# called: the hooks below are only installed on the handlers, ledger,
+# exporter, notifier, account locks and admission control when metrics are
+# switched on, so a bot without METRICS_PORT runs exactly the
+# uninstrumented code.
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+REGISTRY = []
+enabled = False
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f'{self.name}{_format_labels(self.labelnames, labels)} {value}'
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            series = [(labels, list(values)) for labels, values in self._series.items()]
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                yield f'{self.name}_bucket{_format_labels(self.labelnames, labels, [("le", bound)])} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, labels)} {values[-1]}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}'
+
+
+class Gauge:
+    # Read at scrape time from `fn`, which returns a number, or a dict of
+    # label value -> number when `labelnames` has one entry.
+    def __init__(self, name, help, fn, labelnames=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = labelnames
+        REGISTRY.append(self)
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} gauge'
+        value = self.fn()
+        if isinstance(value, dict):
+            for label, item in value.items():
+                yield f'{self.name}{_format_labels(self.labelnames, (label,))} {item}'
+        else:
+            yield f'{self.name} {value}'
+
+
+HANDLER_SECONDS = Histogram('sevenx_handler_seconds', 'Time spent handling an update', ('handler',))
+HANDLER_ERRORS = Counter('sevenx_handler_errors_total', 'Updates whose handler raised', ('handler',))
+QUERY_SECONDS = Histogram('sevenx_query_seconds', 'Time spent running a ledger query on its thread', ('query',))
+COMMITS = Counter('sevenx_commits_total', 'Ledger commits')
+COMMIT_SECONDS = Histogram('sevenx_commit_seconds', 'Time spent in COMMIT')
+COMMIT_BATCH = Histogram('sevenx_commit_batch_size', 'Write operations per commit', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+EXPORT_SECONDS = Histogram('sevenx_export_seconds', 'Time spent writing balances.txt / transactions.txt', ('export',))
+SEND_SECONDS = Histogram('sevenx_notify_seconds', 'Time from queueing a Telegram call to its delivery', ('method',),
+                         buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+LOCK_WAIT_SECONDS = Histogram('sevenx_account_lock_wait_seconds', 'Time spent waiting for a held account lock')
+SHED = Counter('sevenx_shed_requests_total', 'Updates dropped by admission control before their handler ran', ('handler', 'reason'))
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+def instrument(name, callback):
+    # Wraps a handler callback with a latency histogram and an error counter
+    if not enabled:
+        return callback
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, name)
+    return wrapper
+
+def _observe_query(name, seconds):
+    QUERY_SECONDS.observe(seconds, name.lstrip('_'))
+
+def _observe_commit(batch_size, seconds):
+    COMMITS.inc()
+    COMMIT_BATCH.observe(batch_size)
+    COMMIT_SECONDS.observe(seconds)
+
+def _observe_export(name, seconds):
+    EXPORT_SECONDS.observe(seconds, name)
+
+def _observe_send(method, seconds):
+    SEND_SECONDS.observe(seconds, method)
+
+def _observe_lock_wait(seconds):
+    LOCK_WAIT_SECONDS.observe(seconds)
+
+def _observe_shed(handler, reason):
+    SHED.inc(handler, reason)
+
+
+async def _serve(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        path = request.split()[1] if len(request.split()) > 1 else b'/'
+        if path.split(b'?')[0] == b'/metrics':
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except Exception:
+        logger.exception('Metrics request failed')
+    finally:
+        writer.close()
+
+def enable(ledger, exporter, notifier, account_locks, admission):
+    # Switches instrumentation on; call before handlers are registered
+    global enabled
+    enabled = True
+    ledger.observe(query=_observe_query, commit=_observe_commit)
+    exporter.observe_export = _observe_export
+    notifier.observe_send = _observe_send
+    account_locks.observe_wait = _observe_lock_wait
+    admission.observe_shed = _observe_shed
+
+async def serve(port, host='127.0.0.1'):
+    server = await asyncio.start_server(_serve, host, port)
+    logger.info('Serving metrics on http://%s:%d/metrics', host, port)
+    return server
@@ -0,0 +1,184 @@
+import argparse
+import logging
+import sqlite3
+
+from archive import archive_paths, attached
+
+logger = logging.getLogger(__name__)
+
+# One-off migration from username keys (users, user_chat_ids and text
+# sender/receiver columns) to accounts keyed by Telegram user id.
+#
+# The old tables never stored user ids. A private chat's id is the user's
+# id, so a positive stored chat id becomes the account's user id. Every
+# other username gets a provisional negative id, which the account
+# registry replaces with the real one the first time that user is seen.
+#
+# Everything is done in chunks that commit on their own and can simply be
+# run again, so a large ledger never has to fit in memory and an
+# interrupted migration picks up where it stopped. The old columns and
+# tables are dropped at the very end, in one transaction.
+
+CHUNK_SIZE = 5000
+
+
+def _table_exists(conn, name, schema='main'):
+    return conn.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+def _has_column(conn, table, column, schema='main'):
+    return any(row[1] == column for row in conn.execute(f'PRAGMA {schema}.table_info({table})'))
+
+def needs_migration(conn):
+    return _table_exists(conn, 'users')
+
+def _next_provisional_id(conn):
+    # Below every provisional id ever handed out. Merged ones have no
+    # account left, but merged_accounts still sends their credits on.
+    lowest = conn.execute('''
+        SELECT MIN(id) FROM (SELECT MIN(user_id) AS id FROM main.accounts UNION ALL SELECT MIN(old_id) FROM main.merged_accounts)
+    ''').fetchone()[0]
+    return min(lowest or 0, 0) - 1
+
+def _migrate_nameless(conn):
+    # users.username is a TEXT primary key, which SQLite lets be NULL. Such
+    # a balance has no name to be paid or claimed under, but it is part of
+    # the supply, so it moves to a provisional account without a name.
+    count, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(balance), 0) FROM users WHERE username IS NULL').fetchone()
+    if not count:
+        return
+    conn.execute('''
+        INSERT INTO accounts (user_id, balance)
+        SELECT ? - ROW_NUMBER() OVER (ORDER BY rowid), COALESCE(balance, 0) FROM users WHERE username IS NULL
+    ''', (_next_provisional_id(conn) + 1,))
+    conn.execute('DELETE FROM users WHERE username IS NULL')
+    conn.commit()
+    logger.warning('Moved %d users rows without a username (%d SevenX) to nameless provisional accounts', count, total)
+
+def _migrate_accounts(conn, chunk_size):
+    # users joined with their chat id, then chat ids of users without a balance row
+    provisional = _next_provisional_id(conn)
+    for query in ('''SELECT u.username, u.balance, c.chat_id FROM users u LEFT JOIN user_chat_ids c ON c.username = u.username
+                     WHERE u.username > ? ORDER BY u.username LIMIT ?''',
+                  '''SELECT c.username, 0, c.chat_id FROM user_chat_ids c
+                     WHERE c.username > ? AND c.username NOT IN (SELECT username FROM users) ORDER BY c.username LIMIT ?'''):
+        last = ''
+        while True:
+            rows = conn.execute(query, (last, chunk_size)).fetchall()
+            if not rows:
+                break
+            for username, balance, chat_id in rows:
+                if conn.execute('SELECT 1 FROM accounts WHERE username = ?', (username,)).fetchone():
+                    continue  # done by an earlier, interrupted run
+                user_id = chat_id if chat_id is not None and chat_id > 0 else None
+                if user_id is None or conn.execute('SELECT 1 FROM accounts WHERE user_id = ?', (user_id,)).fetchone():
+                    user_id, provisional = provisional, provisional - 1
+                conn.execute('INSERT INTO accounts (user_id, username, chat_id, balance) VALUES (?, ?, ?, ?)',
+                             (user_id, username, chat_id, balance or 0))
+            conn.commit()
+            last = rows[-1][0]
+
+def _add_unknown_names(conn, schema, chunk_size):
+    # Names that only ever appear in transactions get provisional accounts
+    while True:
+        names = [row[0] for row in conn.execute(f'''
+            SELECT name FROM (SELECT sender AS name FROM {schema}.transactions UNION SELECT receiver FROM {schema}.transactions)
+            WHERE name IS NOT NULL AND name NOT IN (SELECT username FROM main.accounts WHERE username IS NOT NULL)
+            LIMIT ?
+        ''', (chunk_size,))]
+        if not names:
+            return
+        provisional = _next_provisional_id(conn)
+        conn.executemany('INSERT INTO main.accounts (user_id, username, balance) VALUES (?, ?, 0)',
+                         ((provisional - i, name) for i, name in enumerate(names)))
+        conn.commit()
+
+def _fill_transaction_ids(conn, schema, chunk_size):
+    first, last = conn.execute(f'SELECT MIN(id), MAX(id) FROM {schema}.transactions').fetchone()
+    if first is None:
+        return
+    for start in range(first, last + 1, chunk_size):
+        conn.execute(f'''
+            UPDATE {schema}.transactions SET
+                sender_id = (SELECT user_id FROM main.accounts WHERE username = sender),
+                receiver_id = (SELECT user_id FROM main.accounts WHERE username = receiver)
+            WHERE id >= ? AND id < ?
+        ''', (start, start + chunk_size))
+        conn.commit()
+
+def _migrate_archive(conn, path, chunk_size):
+    # Archive files get the same treatment, attached to the main database
+    # so names resolve against its accounts
+    with attached(conn, path) as schema:
+        if not _has_column(conn, 'transactions', 'sender', schema):
+            return
+        for column in ('sender_id', 'receiver_id'):
+            if not _has_column(conn, 'transactions', column, schema):
+                conn.execute(f'ALTER TABLE {schema}.transactions ADD COLUMN {column} INTEGER')
+        _add_unknown_names(conn, schema, chunk_size)
+        _fill_transaction_ids(conn, schema, chunk_size)
+        conn.execute('BEGIN')
+        for index in ('idx_transactions_sender', 'idx_transactions_receiver'):
+            conn.execute(f'DROP INDEX IF EXISTS {schema}.{index}')
+        conn.execute(f'ALTER TABLE {schema}.transactions DROP COLUMN sender')
+        conn.execute(f'ALTER TABLE {schema}.transactions DROP COLUMN receiver')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_transactions_sender_id ON transactions (sender_id, id)')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_transactions_receiver_id ON transactions (receiver_id, id)')
+        conn.commit()
+    logger.info('Migrated archive %s', path)
+
+def migrate(conn, archive_dir=None, chunk_size=CHUNK_SIZE):
+    # Expects the new tables and columns to exist already (_create_schema
+    # adds them). Returns True if there was anything to migrate.
+    if not needs_migration(conn):
+        return False
+    logger.info('Migrating accounts from usernames to user ids')
+    # Every step below looks accounts up by name, once per row
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_accounts_username ON accounts (username)')
+    conn.commit()
+    _migrate_nameless(conn)
+    _migrate_accounts(conn, chunk_size)
+    if _has_column(conn, 'transactions', 'sender'):
+        _add_unknown_names(conn, 'main', chunk_size)
+        _fill_transaction_ids(conn, 'main', chunk_size)
+    if _has_column(conn, 'pending_transactions', 'sender'):
+        conn.execute('UPDATE pending_transactions SET sender_id = (SELECT user_id FROM accounts WHERE username = sender)')
+        conn.commit()
+    for path in archive_paths(archive_dir) if archive_dir else []:
+        _migrate_archive(conn, path, chunk_size)
+
+    conn.execute('BEGIN')
+    for index in ('idx_transactions_sender', 'idx_transactions_receiver', 'idx_users_balance'):
+        conn.execute(f'DROP INDEX IF EXISTS {index}')
+    for table, column in (('transactions', 'sender'), ('transactions', 'receiver'), ('pending_transactions', 'sender')):
+        if _has_column(conn, table, column):
+            conn.execute(f'ALTER TABLE {table} DROP COLUMN {column}')
+    conn.execute('DELETE FROM pending_transactions WHERE sender_id IS NULL')
+    conn.execute('DROP TABLE IF EXISTS user_chat_ids')
+    conn.execute('DROP TABLE users')
+    conn.commit()
+    logger.info('Migration finished')
+    return True
+
+
+def main():
+    # Optional: the bot migrates on startup by itself. Running this first
+    # keeps that startup short on a large database.
+    from ledger import _create_schema
+
+    parser = argparse.ArgumentParser(description='Migrate a SevenX database to accounts keyed by user id')
+    parser.add_argument('--db', default='7x_currency.db')
+    parser.add_argument('--archive-dir', default='archive')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    conn = sqlite3.connect(args.db)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        _create_schema(conn, args.archive_dir, args.chunk_size)
+        conn.commit()
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+
+from telegram.error import RetryAfter, TimedOut
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+def _retry_after_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+def _consume_exception(future):
+    # Fire-and-forget sends should not warn about unretrieved exceptions
+    if not future.cancelled():
+        future.exception()
+
+
+class _Job:
+    __slots__ = ('method', 'kwargs', 'future', 'queued', 'attempts', 'span')
+
+    def __init__(self, method, kwargs, future, span=None):
+        self.method = method
+        self.kwargs = kwargs
+        self.future = future
+        self.queued = time.monotonic()
+        self.attempts = 0
+        self.span = span  # the traced update that queued it, if any
+
+
+class Notifier:
+    # Outbound Telegram calls (messages, edits, deletes) run on a pool of
+    # worker tasks instead of inside the handlers.
+    #
+    # Jobs are queued per chat and each chat has at most one job in flight,
+    # so messages to the same chat keep their order. A chat waiting on its
+    # own token bucket is parked with call_later instead of holding a
+    # worker. Every send also draws from a global bucket. A flood-wait
+    # (RetryAfter / HTTP 429) pauses all workers for the time Telegram asks,
+    # and the job is then retried.
+
+    def __init__(self, workers=4, global_rate=30, chat_rate=1, chat_burst=3, max_attempts=5):
+        self.bot = None
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self.depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.latencies = deque(maxlen=1024)
+        self.observe_send = None  # fn(method, seconds from queueing to delivery)
+        self.trace = None  # tracing.Tracer while tracing is on
+        self._global = TokenBucket(global_rate)
+        self._paused_until = 0.0
+        self._chats = {}
+        self._buckets = {}
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = []
+
+    def send(self, method, chat_id, **kwargs):
+        # Queues bot.<method>(chat_id=chat_id, **kwargs) and returns a future
+        # for its result; callers are free to ignore it.
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        job = _Job(method, dict(kwargs, chat_id=chat_id), future,
+                   self.trace.current() if self.trace is not None else None)
+
+        jobs = self._chats.get(chat_id)
+        if jobs is None:
+            jobs = self._chats[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+        jobs.append(job)
+        self.depth += 1
+        self._idle.clear()
+        return future
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.send('send_message', chat_id, text=text, **kwargs)
+
+    def delete_message(self, chat_id, message_id):
+        return self.send('delete_message', chat_id, message_id=message_id)
+
+    def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        return self.send('edit_message_text', chat_id, message_id=message_id, text=text, **kwargs)
+
+    async def _wait_global(self):
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        wait = self._global.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def _deliver(self, job):
+        # True once the job is finished (sent or given up), False to retry it
+        job.attempts += 1
+        try:
+            if job.span is None:
+                result = await getattr(self.bot, job.method)(**job.kwargs)
+            else:
+                with self.trace.resume(job.span, 'notify', job.method, attempt=job.attempts,
+                                       queued_ms=round((time.monotonic() - job.queued) * 1000, 3)):
+                    result = await getattr(self.bot, job.method)(**job.kwargs)
+        except RetryAfter as e:
+            retry_after = _retry_after_seconds(e)
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            if job.attempts < self.max_attempts:
+                self.retried += 1
+                logger.warning('Flood control hit, pausing sends for %.1fs', retry_after)
+                return False
+            self._fail(job, e)
+        except TimedOut as e:
+            if job.attempts < self.max_attempts:
+                self.retried += 1
+                await asyncio.sleep(min(2 ** job.attempts, 30))
+                return False
+            self._fail(job, e)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            self.sent += 1
+            latency = time.monotonic() - job.queued
+            self.latencies.append(latency)
+            if self.observe_send is not None:
+                self.observe_send(job.method, latency)
+            if not job.future.done():
+                job.future.set_result(result)
+        return True
+
+    def _fail(self, job, error):
+        self.failed += 1
+        logger.warning('%s to chat %s failed: %s', job.method, job.kwargs.get('chat_id'), error)
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id = await self._ready.get()
+            jobs = self._chats[chat_id]
+            bucket = self._buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            wait = bucket.delay()
+            if wait > 0:
+                loop.call_later(wait, self._ready.put_nowait, chat_id)
+                continue
+            bucket.try_take()
+
+            await self._wait_global()
+            if await self._deliver(jobs[0]):
+                jobs.popleft()
+                self.depth -= 1
+
+            if jobs:
+                self._ready.put_nowait(chat_id)
+            else:
+                del self._chats[chat_id]
+                if bucket.delay(bucket.burst) == 0:
+                    # A full bucket is the same as a fresh one
+                    del self._buckets[chat_id]
+                if not self._chats:
+                    self._idle.set()
+
+    def start(self, bot):
+        self.bot = bot
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=10):
+        # Give queued messages a chance to go out before shutting down
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Dropping %d queued messages on shutdown', self.depth)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+
+        def quantile(q):
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0.0
+
+        return {
+            'depth': self.depth,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'latency_p50': quantile(0.50),
+            'latency_p95': quantile(0.95),
+            'latency_p99': quantile(0.99),
+        }
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+ID_BLOCK = 1000000
+
+
+def _load_pending(conn):
+    # Takes over whatever the previous run left behind
+    return conn.execute('SELECT id, sender_id, receiver, amount, created_at, chat_id, message_id FROM pending_transactions').fetchall()
+
+def _reserve_ids(conn, start, count):
+    # Advances the table's AUTOINCREMENT counter past a block of ids handed
+    # out from memory, so ids (and stale Confirm buttons) are never reused,
+    # even after a crash. Returns the first id of the block.
+    seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'pending_transactions'").fetchone()
+    first = max(start, seq[0] + 1 if seq else 1)
+    conn.execute("DELETE FROM sqlite_sequence WHERE name = 'pending_transactions'")
+    conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('pending_transactions', ?)", (first + count - 1,))
+    return first
+
+def _save_pending(conn, rows):
+    conn.execute('DELETE FROM pending_transactions')
+    conn.executemany('''
+        INSERT INTO pending_transactions (id, sender_id, receiver, amount, created_at, chat_id, message_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+
+class PendingPayment:
+    __slots__ = ('sender_id', 'receiver', 'amount', 'created', 'chat_id', 'message_id')
+
+    def __init__(self, sender_id, receiver, amount, created, chat_id=None, message_id=None):
+        # `receiver` is the username as typed; it is resolved on confirm
+        self.sender_id = sender_id
+        self.receiver = receiver
+        self.amount = amount
+        self.created = created
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+
+class PendingStore:
+    # /pay prompts waiting for Confirm or Cancel. They live in memory and
+    # expire after `ttl` seconds; a sweeper edits expired prompts so their
+    # buttons go away. The pending_transactions table is only written on
+    # shutdown and read back on startup, so a restart keeps open prompts
+    # without a commit per /pay. `created` is wall-clock time so it stays
+    # meaningful across that restart.
+
+    def __init__(self, ledger, notifier, ttl=300, sweep_interval=30):
+        self.ledger = ledger
+        self.notifier = notifier
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.expired = 0
+        self._items = {}
+        self._next_id = 1
+        self._reserved = 0  # last id of the reserved block
+        self._reserving = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._items)
+
+    async def load(self):
+        rows = await self.ledger.read(_load_pending)
+        now = time.time()
+        for trans_id, sender_id, receiver, amount, created, chat_id, message_id in rows:
+            # Rows from before expiry existed get a fresh ttl
+            self._items[trans_id] = PendingPayment(sender_id, receiver, amount, created or now, chat_id, message_id)
+        self._next_id = await self.ledger.write(_reserve_ids, max(self._items, default=0) + 1, ID_BLOCK)
+        self._reserved = self._next_id + ID_BLOCK - 1
+
+    async def _reserve_more(self):
+        first = await self.ledger.write(_reserve_ids, self._reserved + 1, ID_BLOCK)
+        self._reserved = first + ID_BLOCK - 1
+
+    async def save(self):
+        rows = [(trans_id, p.sender_id, p.receiver, p.amount, p.created, p.chat_id, p.message_id)
+                for trans_id, p in self._items.items()]
+        await self.ledger.write(_save_pending, rows)
+
+    def add(self, sender_id, receiver, amount):
+        trans_id = self._next_id
+        self._next_id += 1
+        if self._reserved - trans_id < ID_BLOCK // 2 and (self._reserving is None or self._reserving.done()):
+            # Top up the id block well before it runs out
+            self._reserving = asyncio.get_running_loop().create_task(self._reserve_more())
+        self._items[trans_id] = PendingPayment(sender_id, receiver, amount, time.time())
+        return trans_id
+
+    def attach(self, trans_id, chat_id, message_id):
+        # Remember where the prompt was shown so it can be edited on expiry
+        pending = self._items.get(trans_id)
+        if pending is not None:
+            pending.chat_id = chat_id
+            pending.message_id = message_id
+
+    def get(self, trans_id):
+        # The payment, or None if it is unknown, already handled or expired
+        pending = self._items.get(trans_id)
+        if pending is None or time.time() - pending.created > self.ttl:
+            return None
+        return pending
+
+    def pop(self, trans_id):
+        pending = self.get(trans_id)
+        self._items.pop(trans_id, None)
+        return pending
+
+    def sweep(self):
+        cutoff = time.time() - self.ttl
+        expired = [trans_id for trans_id, p in self._items.items() if p.created < cutoff]
+        for trans_id in expired:
+            pending = self._items.pop(trans_id)
+            self.expired += 1
+            if pending.message_id is not None:
+                self.notifier.edit_message_text(pending.chat_id, pending.message_id,
+                                                f'Payment of {pending.amount} SevenX to {pending.receiver} expired.')
+        return len(expired)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception('Pending payment sweep failed')
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.save()
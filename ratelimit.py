@@ -0,0 +1,38 @@
+import time
+
+
+class TokenBucket:
+    # Classic token bucket: `rate` tokens per second, holding at most `burst`.
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, n=1):
+        self._refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def delay(self, n=1):
+        # Seconds until `n` tokens are available, without taking them
+        self._refill()
+        if self.tokens >= n:
+            return 0.0
+        return (n - self.tokens) / self.rate
+
+    def reserve(self, n=1):
+        # Takes `n` tokens now, going into debt if needed, and returns how
+        # long the caller has to wait before acting on them.
+        self._refill()
+        self.tokens -= n
+        return max(0.0, -self.tokens / self.rate)
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+
+from archive import archive_paths, attached
+from ledger import SYSTEM_ID
+
+logger = logging.getLogger(__name__)
+
+# Every balance change is a transactions row (mints, burns and claims have
+# SYSTEM_ID on the other side), so an account's balance is its balance at
+# some earlier point plus what it received minus what it sent since.
+#
+# A checkpoint records, for the id of the last transaction it covers, the
+# ledger balance of every account that moved since the checkpoint before
+# it; an account's balance at a checkpoint is its newest row at or before
+# that checkpoint, and 0 if it has none. The first checkpoint is a
+# snapshot of all balances as they stand, since older databases never
+# recorded mints. SYSTEM_ID's balance is minus the total supply.
+#
+# Checking an interval only reads the transactions since the last
+# checkpoint, so its cost follows the traffic, not the number of accounts.
+# The archiver keeps those transactions in the hot table.
+
+
+def _last_transaction_id(conn):
+    # Archiving can empty the hot table, the sequence still knows
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'transactions'").fetchone()
+    return row[0] if row else 0
+
+def _latest_checkpoint(conn):
+    return conn.execute('SELECT id, tx_id FROM checkpoints ORDER BY id DESC LIMIT 1').fetchone()
+
+def _checkpoint_balance(conn, user_id, checkpoint_id):
+    row = conn.execute('''
+        SELECT balance FROM checkpoint_balances WHERE user_id = ? AND checkpoint_id <= ?
+        ORDER BY checkpoint_id DESC LIMIT 1
+    ''', (user_id, checkpoint_id)).fetchone()
+    return row[0] if row else 0
+
+def _recorded_balances(conn, user_ids):
+    # What the accounts table says, and the supply for SYSTEM_ID
+    found = {}
+    accounts = [user_id for user_id in user_ids if user_id != SYSTEM_ID]
+    for i in range(0, len(accounts), 500):
+        chunk = accounts[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        found.update(conn.execute(f'SELECT user_id, balance FROM accounts WHERE user_id IN ({placeholders})', chunk))
+    if SYSTEM_ID in user_ids:
+        found[SYSTEM_ID] = -conn.execute('SELECT total FROM supply WHERE id = 0').fetchone()[0]
+    return found
+
+def _baseline(conn):
+    tx_id = _last_transaction_id(conn)
+    checkpoint_id = conn.execute('INSERT INTO checkpoints (tx_id) VALUES (?)', (tx_id,)).lastrowid
+    conn.execute('''
+        INSERT INTO checkpoint_balances (user_id, checkpoint_id, balance)
+        SELECT user_id, ?, balance FROM accounts WHERE balance != 0
+    ''', (checkpoint_id,))
+    conn.execute('INSERT INTO checkpoint_balances (user_id, checkpoint_id, balance) SELECT ?, ?, -total FROM supply WHERE id = 0',
+                 (SYSTEM_ID, checkpoint_id))
+    return (checkpoint_id, tx_id), [], {}
+
+def _checkpoint(conn):
+    # Runs on the writer thread, so no balance or transaction moves while it
+    # looks. Returns the new (checkpoint id, transaction id), the accounts it
+    # checked and {user id: (recorded, ledger)} for those that disagree.
+    latest = _latest_checkpoint(conn)
+    if latest is None:
+        return _baseline(conn)
+    checkpoint_id, since = latest
+    upto = _last_transaction_id(conn)
+    if upto == since:
+        return latest, [], {}
+    deltas = dict(conn.execute('''
+        SELECT user_id, SUM(delta) FROM (
+            SELECT receiver_id AS user_id, amount AS delta FROM transactions WHERE id > :since AND id <= :upto
+            UNION ALL
+            SELECT sender_id, -amount FROM transactions WHERE id > :since AND id <= :upto
+        ) GROUP BY user_id
+    ''', {'since': since, 'upto': upto}))
+    recorded = _recorded_balances(conn, list(deltas))
+    new_id = conn.execute('INSERT INTO checkpoints (tx_id) VALUES (?)', (upto,)).lastrowid
+    rows, drift = [], {}
+    for user_id, delta in deltas.items():
+        expected = _checkpoint_balance(conn, user_id, checkpoint_id) + delta
+        actual = recorded.get(user_id, 0)
+        if actual != expected:
+            drift[user_id] = (actual, expected)
+        # The ledger is the reference, so a drifted account keeps being
+        # flagged until its balance is put right
+        rows.append((user_id, new_id, expected))
+    conn.executemany('INSERT INTO checkpoint_balances (user_id, checkpoint_id, balance) VALUES (?, ?, ?)', rows)
+    return (new_id, upto), list(deltas), drift
+
+def _merge_checkpoints(conn, old_id, new_id):
+    # An account merge moves the old account's transactions to the new id,
+    # so its checkpointed balances have to follow: at every checkpoint
+    # either has a row for, the new id holds the sum of both
+    rows = conn.execute('SELECT checkpoint_id, user_id, balance FROM checkpoint_balances WHERE user_id IN (?, ?) ORDER BY checkpoint_id',
+                        (old_id, new_id)).fetchall()
+    if not rows:
+        return
+    latest = {old_id: 0, new_id: 0}
+    merged = {}
+    for checkpoint_id, user_id, balance in rows:
+        latest[user_id] = balance
+        merged[checkpoint_id] = latest[old_id] + latest[new_id]
+    conn.execute('DELETE FROM checkpoint_balances WHERE user_id IN (?, ?)', (old_id, new_id))
+    conn.executemany('INSERT INTO checkpoint_balances (user_id, checkpoint_id, balance) VALUES (?, ?, ?)',
+                     ((new_id, checkpoint_id, balance) for checkpoint_id, balance in merged.items()))
+
+def _net_change(conn, user_id, after_id, upto_id, condition, when, archive_dir):
+    # Received minus sent over ids (after_id, upto_id] whose timestamp meets
+    # `condition`, in the hot table and the archives
+    def net(schema):
+        return conn.execute(f'''
+            SELECT (SELECT COALESCE(SUM(amount), 0) FROM {schema}.transactions
+                    WHERE receiver_id = :user AND id > :after AND id <= :upto AND timestamp {condition} :when)
+                 - (SELECT COALESCE(SUM(amount), 0) FROM {schema}.transactions
+                    WHERE sender_id = :user AND id > :after AND id <= :upto AND timestamp {condition} :when)
+        ''', {'user': user_id, 'after': after_id, 'upto': upto_id, 'when': when}).fetchone()[0]
+
+    total = net('main')
+    for path in archive_paths(archive_dir) if archive_dir else []:
+        with attached(conn, path) as schema:
+            total += net(schema)
+    return total
+
+def _balance_at(conn, user_id, when, archive_dir):
+    # The user's balance at `when` (a UTC timestamp as SQLite stores them),
+    # None before anything was checkpointed. A checkpoint made at or before
+    # `when` covers everything up to it; of the transactions after it, the
+    # ones stamped up to `when` are added. Transactions after the next
+    # checkpoint were all stamped after it, so the search stops there.
+    # Before the first checkpoint the answer only accounts for transfers.
+    before = conn.execute('SELECT id, tx_id FROM checkpoints WHERE created_at <= ? ORDER BY id DESC LIMIT 1', (when,)).fetchone()
+    if before is None:
+        first = conn.execute('SELECT id, tx_id FROM checkpoints ORDER BY id LIMIT 1').fetchone()
+        if first is None:
+            return None
+        return _checkpoint_balance(conn, user_id, first[0]) - _net_change(conn, user_id, 0, first[1], '>', when, archive_dir)
+    checkpoint_id, since = before
+    following = conn.execute('SELECT tx_id FROM checkpoints WHERE id > ? ORDER BY id LIMIT 1', (checkpoint_id,)).fetchone()
+    upto = following[0] if following else 2 ** 63 - 1
+    return _checkpoint_balance(conn, user_id, checkpoint_id) + _net_change(conn, user_id, since, upto, '<=', when, archive_dir)
+
+
+class Reconciler:
+    # Checkpoints and checks the ledger every `interval` seconds while the
+    # bot runs. Accounts whose balance disagrees with the ledger are logged
+    # and kept in `drifted` (user id -> (recorded, ledger)) until a later
+    # check finds them right again.
+
+    def __init__(self, ledger, interval=600):
+        self.ledger = ledger
+        self.interval = interval
+        self.checkpoint = None  # (checkpoint id, last transaction id it covers)
+        self.checked = 0
+        self.drifted = {}
+        self._stopping = asyncio.Event()
+        self._task = None
+
+    def verified_id(self):
+        # Transactions after this id are not checkpointed yet and have to
+        # stay in the hot table; 0 until the first check
+        return self.checkpoint[1] if self.checkpoint else 0
+
+    async def check(self):
+        self.checkpoint, checked, drift = await self.ledger.write(_checkpoint)
+        self.checked += len(checked)
+        for user_id in checked:
+            if user_id not in drift:
+                self.drifted.pop(user_id, None)
+        self.drifted.update(drift)
+        for user_id, (recorded, expected) in drift.items():
+            logger.warning('Account %s has %s SevenX, the ledger says %s', user_id, recorded, expected)
+        return drift
+
+    async def balance_at(self, user_id, when):
+        return await self.ledger.read(_balance_at, user_id, when, self.ledger.archive_dir)
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await self.check()
+            except Exception:
+                logger.exception('Reconciliation failed, retrying in %ss', self.interval)
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._stopping.set()
+        if self._task:
+            await self._task
+            self._task = None
+
+    def stats(self):
+        return {'checkpoint': self.checkpoint[0] if self.checkpoint else 0, 'verified_id': self.verified_id(),
+                'checked': self.checked, 'drifted': len(self.drifted)}
@@ -0,0 +1,58 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from accounts import AccountRegistry
+from ledger import Ledger
+
+
+class ProvisionalAccountTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.ledger = Ledger(os.path.join(self.tmp.name, 'ledger.db'))
+        self.accounts = AccountRegistry(self.ledger)
+        await self.ledger.update_balance(1, 100)
+
+    async def asyncTearDown(self):
+        self.ledger.close()
+        self.tmp.cleanup()
+
+    async def test_merged_id_is_not_reused(self):
+        # Pay a name, let its owner show up, then pay a new name: the new
+        # provisional account must not inherit the merged id, or
+        # merged_accounts would send its money to the first owner
+        alice = await self.accounts.resolve('alice', create=True)
+        await self.ledger.transfer(1, alice, 10)
+        await self.accounts.remember(123, 'alice', 123)
+        await self.accounts.flush()
+
+        bob = await self.accounts.resolve('bob', create=True)
+        self.assertNotEqual(bob, alice)
+        await self.ledger.transfer(1, bob, 5)
+
+        self.assertEqual(await self.ledger.get_balance(123), 10)
+        self.assertEqual(await self.ledger.get_balance(bob), 5)
+
+    async def test_claim_sees_provisional_payment(self):
+        # /claim only pays out to an empty account, so the money sent to
+        # the name has to be the user's as soon as they are remembered,
+        # not after the next batched flush
+        alice = await self.accounts.resolve('alice', create=True)
+        await self.ledger.transfer(1, alice, 10)
+        await self.accounts.remember(123, 'alice', 123)
+
+        self.assertEqual(await self.ledger.get_balance(123), 10)
+        self.assertIsNone(await self.ledger.find_balance(alice))
+
+    async def test_same_user_waits_for_registration(self):
+        alice = await self.accounts.resolve('alice', create=True)
+        await self.ledger.transfer(1, alice, 10)
+        await asyncio.gather(self.accounts.remember(123, 'alice', 123), self.accounts.remember(123, 'alice', 123))
+
+        self.assertEqual(await self.ledger.get_balance(123), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
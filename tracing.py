@@ -0,0 +1,162 @@
+import asyncio
+import contextvars
+import functools
+import itertools
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager, nullcontext
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Request tracing for debugging the live bot. A sampled update gets a span
+# for its handler, with child spans for every ledger read and write it
+# awaits and every Telegram call it makes, including the ones the notifier
+# sends for it later. Finished spans are written as JSON lines, one per
+# span, by a background task:
+#
+#   {"trace": "9f3c...", "span": 4, "parent": 1, "name": "db.write", "op": "_transfer",
+#    "start": 1718000000.123, "ms": 1.92}
+#
+# Like metrics, nothing is hooked in unless tracing is switched on, so the
+# handlers, ledger and notifier run their usual code when it is off.
+
+NO_SPAN = nullcontext()
+
+_current = contextvars.ContextVar('span', default=None)
+
+
+class _Span:
+    __slots__ = ('trace', 'id', 'parent', 'name', 'op', 'start', 'attrs')
+
+    def __init__(self, trace, id, parent, name, op, attrs):
+        self.trace = trace
+        self.id = id
+        self.parent = parent
+        self.name = name
+        self.op = op
+        self.start = time.time()
+        self.attrs = attrs
+
+
+class TracingRequest(HTTPXRequest):
+    # Bot API requests, each in a span named after the API method
+    def __init__(self, tracer, **kwargs):
+        super().__init__(**kwargs)
+        self._tracer = tracer
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        with self._tracer.span('telegram', url.rsplit('/', 1)[-1]):
+            return await super().do_request(url, method, request_data, **kwargs)
+
+
+class Tracer:
+    # Traces `sample_rate` of all updates (0 to 1) into `path`. Spans are
+    # buffered in memory and appended every `flush_interval` seconds off the
+    # event loop; past `max_buffer` unwritten spans, new ones are dropped.
+
+    def __init__(self, path='trace.jsonl', sample_rate=0.01, flush_interval=1.0, max_buffer=100000):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.dropped = 0
+        self._ids = itertools.count(1)
+        self._buffer = []
+        self._stopping = asyncio.Event()
+        self._task = None
+
+    def attach(self, ledger, notifier):
+        ledger.trace = self.span
+        notifier.trace = self
+
+    def request(self, **kwargs):
+        # Bot request object for ApplicationBuilder().request(); same pool
+        # size as the builder's own default
+        return TracingRequest(self, **dict({'connection_pool_size': 256}, **kwargs))
+
+    def _finish(self, span, error=None):
+        if len(self._buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+        record = {'trace': span.trace, 'span': span.id, 'parent': span.parent, 'name': span.name, 'op': span.op,
+                  'start': round(span.start, 6), 'ms': round((time.time() - span.start) * 1000, 3)}
+        record.update(span.attrs)
+        if error is not None:
+            record['error'] = type(error).__name__
+        self._buffer.append(record)
+
+    def current(self):
+        return _current.get()
+
+    @contextmanager
+    def _run(self, span):
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            self._finish(span, e)
+            raise
+        else:
+            self._finish(span)
+        finally:
+            _current.reset(token)
+
+    def span(self, name, op=None, **attrs):
+        # A child of the current span; nothing at all outside a sampled update
+        parent = _current.get()
+        if parent is None:
+            return NO_SPAN
+        return self._run(_Span(parent.trace, next(self._ids), parent.id, name, op, attrs))
+
+    def resume(self, parent, name, op=None, **attrs):
+        # A child of `parent` from another task, e.g. a notifier worker
+        return self._run(_Span(parent.trace, next(self._ids), parent.id, name, op, attrs))
+
+    def instrument(self, name, callback):
+        # Wraps a handler callback; sampled updates become new traces
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            if random.random() >= self.sample_rate:
+                return await callback(update, context)
+            user = update.effective_user
+            span = _Span(f'{random.getrandbits(64):016x}', next(self._ids), None, 'update', name,
+                         {'update_id': update.update_id, 'user': user.id if user else None})
+            with self._run(span):
+                return await callback(update, context)
+        return wrapper
+
+    def _write(self, records):
+        with open(self.path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record, default=str) + '\n')
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        records, self._buffer = self._buffer, []
+        await asyncio.get_running_loop().run_in_executor(None, self._write, records)
+
+    async def _run_flusher(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Failed to write trace spans')
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run_flusher())
+        logger.info('Tracing %.1f%% of updates to %s', self.sample_rate * 100, self.path)
+
+    async def stop(self):
+        self._stopping.set()
+        if self._task:
+            await self._task
+            self._task = None